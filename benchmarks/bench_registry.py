@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks of lain_admin_cli.registry against an in-process fake registry,
+every benchmark runs in its own process and reports the wall time, the
+number of http requests registry received and the peak rss.
+
+    python benchmarks/bench_registry.py --repos 50 --tags 100 --latency 0.005
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_registry import FakeRegistry, DAY
+from lain_admin_cli import registry
+
+CLEAN_REMAIN_NUM = 5
+CLEAN_REMAIN_TIME = 10 * DAY
+
+
+def bench_list(session, args):
+    list(registry._registry_repos(session, args.page_size))
+
+
+def bench_list_target(session, args):
+    list(registry._iter_repo_images(session, "app0000", args.concurrency,
+                                    args.page_size))
+
+
+def bench_list_sort(session, args):
+    registry.ordered_images(session, "app0000", args.concurrency, args.page_size)
+
+
+def bench_clean(session, args):
+    registry.clear_all_expired_repos(session, CLEAN_REMAIN_NUM, CLEAN_REMAIN_TIME,
+                                     args.concurrency, args.parallel,
+                                     args.page_size)
+
+
+def bench_delete(session, args):
+    registry.delete_repo(session, "app0000", args.concurrency, args.page_size)
+
+
+BENCHMARKS = [
+    ('list', bench_list),
+    ('list-target', bench_list_target),
+    ('list-sort', bench_list_sort),
+    ('clean', bench_clean),
+    ('delete', bench_delete),
+]
+
+
+def _run(func, args, queue):
+    fake = FakeRegistry(args.repos, args.tags, args.latency, args.auth).start()
+    registry.registry_host = fake.host
+    registry._limit_requests(args.max_requests)
+    session = registry._session(args.concurrency * args.parallel)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        start = time.time()
+        func(session, args)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        fake.stop()
+    # ru_maxrss is in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put({'time': elapsed, 'requests': fake.request_count,
+               'by_method': fake.requests, 'peak_rss_mb': peak})
+
+
+def run_benchmark(func, args):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run, args=(func, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repos', type=int, default=20)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="seconds every fake registry request takes")
+    parser.add_argument('--auth', action='store_true',
+                        help="answer unauthorized requests with a token challenge")
+    parser.add_argument('--concurrency', type=int, default=registry.DEFAULT_CONCURRENCY)
+    parser.add_argument('--parallel', type=int, default=1)
+    parser.add_argument('--max-requests', type=int, default=registry.DEFAULT_MAX_REQUESTS)
+    parser.add_argument('--page-size', type=int, default=registry.DEFAULT_PAGE_SIZE)
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument('--json', help="also write the results into this file")
+    args = parser.parse_args()
+
+    results = {}
+    row_fmt = "%-14s%-10s%-10s%s"
+    print(row_fmt % ("BENCHMARK", "TIME(s)", "REQUESTS", "PEAK RSS(MB)"))
+    for name, func in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        result = results[name] = run_benchmark(func, args)
+        print(row_fmt % (name, "%.3f" % result['time'], result['requests'],
+                         "%.1f" % result['peak_rss_mb']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
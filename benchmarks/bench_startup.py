@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+startup benchmark of lainctl, every command line runs in a fresh python
+process and reports the time from interpreter start to the end of dispatch,
+the number of modules imported and how often etcd was touched (etcd.Client
+created or etcdctl spawned). Commands that do not need etcd must not touch
+it, the benchmark exits 1 if they do.
+
+    python benchmarks/bench_startup.py
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# none of these should need etcd
+COMMANDS = [
+    ['version'],
+    ['--help'],
+    ['node', '--help'],
+    ['node', 'list', '--help'],
+    ['registry', 'list', '--help'],
+    ['auth', 'open', '--help'],
+    ['cluster', 'health', '--help'],
+    ['drift', '--help'],
+    ['config', 'get', '--help'],
+]
+
+
+def child(argv):
+    start = float(os.environ['BENCH_START'])
+    etcd_calls = []
+
+    import etcd
+    client_init = etcd.Client.__init__
+
+    def init(self, *args, **kwargs):
+        etcd_calls.append('etcd.Client')
+        client_init(self, *args, **kwargs)
+    etcd.Client.__init__ = init
+
+    popen = subprocess.Popen
+
+    class Popen(popen):
+        def __init__(self, args, *rest, **kwargs):
+            if args and args[0] == 'etcdctl':
+                etcd_calls.append(' '.join(args))
+            popen.__init__(self, args, *rest, **kwargs)
+    subprocess.Popen = Popen
+
+    before = len(sys.modules)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        from lain_admin_cli.cli import main
+        main(argv)
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = stdout
+    print(json.dumps({'time': time.time() - start,
+                      'modules': len(sys.modules) - before,
+                      'etcd': etcd_calls}))
+
+
+def run(argv):
+    env = dict(os.environ, BENCH_START=repr(time.time()),
+               PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child'] + argv, env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        return child(sys.argv[2:])
+    row_fmt = "%-32s%-10s%-10s%s"
+    print(row_fmt % ("COMMAND", "TIME(s)", "MODULES", "ETCD"))
+    touched = False
+    for argv in COMMANDS:
+        result = run(argv)
+        touched = touched or bool(result['etcd'])
+        print(row_fmt % (' '.join(argv), "%.3f" % result['time'], result['modules'],
+                         ', '.join(result['etcd']) or '-'))
+    if touched:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+an in-process stand-in for docker registry v2, only the apis lainctl uses
+are implemented: catalog and tags pagination, manifest HEAD/GET/DELETE
+and an optional bearer token challenge.
+"""
+import hashlib
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+TOKEN = "fake-token"
+DAY = 24 * 3600
+
+
+def _digest(text):
+    return "sha256:" + hashlib.sha256(text).hexdigest()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeRegistry(object):
+    """
+    a registry holding `repos` repositories of `tags` release tags each,
+    every request sleeps `latency` seconds before it is answered
+    """
+
+    def __init__(self, repos=10, tags=20, latency=0.0, auth=False,
+                 layers=3, max_page_size=1000):
+        self.latency = latency
+        self.auth = auth
+        self.max_page_size = max_page_size
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.repos = {}
+        self.manifests = {}
+        now = int(time.time())
+        for r in range(repos):
+            repo = "app%04d" % r
+            self.repos[repo] = {}
+            for t in range(tags):
+                # one release a day, going back from now
+                ts = now - (t + 1) * DAY
+                tag = "release-%d-%07x" % (ts, t)
+                blobs = [{'digest': _digest("base-%d" % i), 'size': 10 << 20}
+                         for i in range(layers - 1)]
+                blobs.append({'digest': _digest("%s-%s" % (repo, tag)),
+                              'size': 1 << 20})
+                manifest = json.dumps({
+                    'schemaVersion': 2,
+                    'mediaType': MANIFEST_V2,
+                    'config': {'digest': _digest("config-%s-%s" % (repo, tag)),
+                               'size': 1024},
+                    'layers': blobs,
+                })
+                digest = _digest(manifest)
+                self.repos[repo][tag] = digest
+                self.manifests[digest] = manifest
+        self.server = None
+        self.thread = None
+
+    @property
+    def host(self):
+        return "127.0.0.1:%d" % self.server.server_address[1]
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', 0), _handler(self))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+
+def _handler(registry):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # buffer the response and flush it at once, so that small writes
+        # do not wait on delayed acks
+        wbufsize = -1
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_HEAD(self):
+            self._handle('HEAD')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def _reply(self, code, body='', headers=None):
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+            self.wfile.flush()
+
+        def _handle(self, method):
+            registry.count(method)
+            if registry.latency:
+                time.sleep(registry.latency)
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/token':
+                return self._reply(200, json.dumps({'token': TOKEN, 'expires_in': 300}))
+            if not url.path.startswith('/v2/'):
+                return self._reply(404)
+            path = url.path[len('/v2/'):]
+            if registry.auth and self.headers.get('Authorization') != 'Bearer %s' % TOKEN:
+                repo = path.split('/')[0]
+                challenge = 'Bearer realm="http://%s/token",service="fake",scope="repository:%s:%s"' % (
+                    registry.host, repo, 'pull' if method != 'DELETE' else 'delete')
+                return self._reply(401, headers={'Www-Authenticate': challenge})
+            if path == '_catalog':
+                return self._page(url.path, 'repositories', sorted(registry.repos), query)
+            if path.endswith('/tags/list'):
+                repo = path[:-len('/tags/list')]
+                with registry.lock:
+                    tags = sorted(registry.repos.get(repo, {}))
+                return self._page(url.path, 'tags', tags, query, name=repo)
+            if '/manifests/' in path:
+                repo, reference = path.split('/manifests/')
+                return self._manifest(method, repo, reference)
+            return self._reply(404)
+
+        def _page(self, path, key, items, query, **extra):
+            n = min(int(query.get('n', [registry.max_page_size])[0]),
+                    registry.max_page_size)
+            last = query.get('last', [''])[0]
+            rest = [item for item in items if item > last]
+            page, headers = rest[:n], {}
+            if len(rest) > n:
+                headers['Link'] = '<%s?n=%d&last=%s>; rel="next"' % (path, n, page[-1])
+            extra[key] = page
+            return self._reply(200, json.dumps(extra), headers)
+
+        def _manifest(self, method, repo, reference):
+            code, body, headers = 404, '', {}
+            with registry.lock:
+                tags = registry.repos.get(repo, {})
+                digest = reference if reference.startswith('sha256:') else tags.get(reference)
+                if digest is not None and digest in tags.values():
+                    if method == 'DELETE':
+                        for tag in [t for t, d in tags.items() if d == digest]:
+                            del tags[tag]
+                        code = 202
+                    else:
+                        code, body = 200, registry.manifests[digest]
+                        headers = {'Docker-Content-Digest': digest,
+                                   'Content-Type': MANIFEST_V2}
+            return self._reply(code, body, headers)
+
+    return Handler
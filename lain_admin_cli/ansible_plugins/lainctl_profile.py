@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+ansible callback plugin enabled by `lainctl ... --ansible-profile`, it
+records when every task starts and when every host finishes it, and dumps
+them as json into $LAINCTL_ANSIBLE_PROFILE at the end of the playbook.
+
+it is loaded by ansible-playbook, never imported by lainctl itself.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'lainctl_profile'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.path = os.environ.get('LAINCTL_ANSIBLE_PROFILE')
+        self.start = time.time()
+        self.tasks = []
+        self.current = None
+
+    def _now(self):
+        return time.time() - self.start
+
+    def _end_task(self):
+        if self.current is not None:
+            self.current['duration'] = self._now() - self.current['start']
+
+    def _start_task(self, task):
+        self._end_task()
+        role = getattr(task, '_role', None)
+        self.current = {
+            'name': task.get_name().strip(),
+            'role': role.get_name() if role else '',
+            'start': self._now(),
+            'duration': 0,
+            'hosts': {},
+        }
+        self.tasks.append(self.current)
+
+    def _host_done(self, result, status):
+        if self.current is None:
+            return
+        self.current['hosts'][result._host.get_name()] = {
+            'status': status,
+            'duration': self._now() - self.current['start'],
+        }
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start_task(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start_task(task)
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self._host_done(result, 'ok')
+
+    def v2_runner_on_failed(self, result, **kwargs):
+        self._host_done(result, 'failed')
+
+    def v2_runner_on_skipped(self, result, **kwargs):
+        self._host_done(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        self._host_done(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        self._end_task()
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump({'elapsed': self._now(), 'tasks': self.tasks}, f)
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import time
-import etcd
 import json
 import hashlib
 import requests
@@ -9,34 +8,26 @@ from os import environ
 from argh.decorators import arg, expects_obj
 from lain_admin_cli.helpers import TwoLevelCommandBase
 from subprocess import check_output, call
-from lain_admin_cli.helpers import info, error, sso_login
+from lain_admin_cli.helpers import info, warn, error, println, sso_login, get_cluster_config
+from lain_admin_cli.utils.concurrency import parallel_map, pooled_session, RateLimiter
 
-
-def get_etcd_client(etcd_authority):
-    etcd_host_and_port = etcd_authority.split(":")
-    if len(etcd_host_and_port) == 2:
-        return etcd.Client(host=etcd_host_and_port[0], port=int(etcd_host_and_port[1]))
-    elif len(etcd_host_and_port) == 1:
-        return etcd.Client(host=etcd_host_and_port[0], port=4001)
-    else:
-        raise Exception("invalid ETCD_AUTHORITY : %s" % etcd_authority)
+SSO_CONCURRENCY = int(environ.get('SSO_CONCURRENCY', 8))
+# requests per second sent to sso when creating groups
+SSO_RATE = float(environ.get('SSO_RATE', 5))
 
 
 def get_console_domain():
     try:
         etcd_authority = environ.get("CONSOLE_ETCD_HOST", "etcd.lain:4001")
-        client = get_etcd_client(etcd_authority)
-        domain = client.read("/lain/config/domain").value
-        try:
-            main_domain = json.loads(client.read(
-                "/lain/config/extra_domains").value)[0]
-        except Exception as e:
-            print("use %s as a default prefix of group name" % domain)
-        else:
-            domain = main_domain
-        return domain
+        config = get_cluster_config(etcd_authority)
     except Exception:
         raise Exception("unable to get the console domain!")
+    domain = config.console_domain
+    if domain is None:
+        raise Exception("unable to get the console domain!")
+    if domain == config.domain:
+        print("use %s as a default prefix of group name" % domain)
+    return domain
 
 
 class Auth(TwoLevelCommandBase):
@@ -60,6 +51,8 @@ class Auth(TwoLevelCommandBase):
     @arg('-r', '--redirect_uri', default='https://example.com/', help="Redirect uri get from the sso system.")
     @arg('-u', '--sso_url', default='http://sso.lain.local', help="The sso_url need to be process")
     @arg('-a', '--check_all', default=False, help="Whether check all apps to create app groups in sso")
+    @arg('--concurrency', type=int, default=SSO_CONCURRENCY, help="number of groups created at the same time")
+    @arg('--rate', type=float, default=SSO_RATE, help="max requests per second sent to sso, 0 for unlimited")
     def init(self, args):
         '''
         init the auth of lain, create groups in sso for lain apps
@@ -67,7 +60,8 @@ class Auth(TwoLevelCommandBase):
         login_success, token = sso_login(
             args.sso_url, args.cid, args.secret, args.redirect_uri)
         if login_success:
-            add_sso_groups(args.sso_url, token, args.check_all)
+            add_sso_groups(args.sso_url, token, args.check_all,
+                           args.concurrency, args.rate)
         else:
             error("login failed.")
             exit(1)
@@ -77,8 +71,9 @@ class Auth(TwoLevelCommandBase):
     @arg('-s', '--scope', default='all', choices=['console', 'all'])
     @arg('-t', '--type', default='lain-sso', help='The auth type for console')
     @arg('-u', '--url', default='http://sso.lain.local', help='the auth url for console')
-    @arg('-r', '--realm', default='http://console.%s/api/v1/authorize/registry/' % get_console_domain(),
-         help='the realm in which the registry server authenticates')
+    @arg('-r', '--realm', default=None,
+         help='the realm in which the registry server authenticates, '
+              'http://console.<console domain>/api/v1/authorize/registry/ by default')
     @arg('-i', '--issuer', default='auth server', help='the name of registry token issuer')
     def open(self, args):
         '''
@@ -112,32 +107,52 @@ class Auth(TwoLevelCommandBase):
 
 
 # as in console/authorize/utils.py
-def get_group_name_for_app(appname):
-    appname_prefix = environ.get(
-        "SSO_GROUP_NAME_PREFIX", "lainapp-%s" % get_console_domain())
+def get_group_name_for_app(appname, domain=None):
+    appname_prefix = environ.get("SSO_GROUP_NAME_PREFIX")
+    if appname_prefix is None:
+        appname_prefix = "lainapp-%s" % (domain or get_console_domain())
     return (appname_prefix + "-" + appname).replace('.', '-')
 
 # as in console/authorize/utils.py
 
 
-def get_group_fullname_for_app(appname):
-    group_fullname_prefix = environ.get(
-        "SSO_GROUP_FULLNAME_PREFIX", "lain app in %s: " % get_console_domain())
+def get_group_fullname_for_app(appname, domain=None):
+    group_fullname_prefix = environ.get("SSO_GROUP_FULLNAME_PREFIX")
+    if group_fullname_prefix is None:
+        group_fullname_prefix = "lain app in %s: " % (domain or get_console_domain())
     return "%s%s" % (group_fullname_prefix, appname)
 
 # as in console/authorize/utils.py
 
 
-def add_subgroup_for_admin(sso_url, access_token, appname, subname, role):
-    group_name = get_group_name_for_app(appname)
+def add_subgroup_for_admin(sso_url, access_token, appname, subname, role,
+                           session=requests, domain=None):
+    group_name = get_group_name_for_app(appname, domain)
     member_msg = {'role': role}
     headers = {"Content-Type": "application/json",
                "Accept": "application/json", 'Authorization': 'Bearer %s' % access_token}
     url = "%s/api/groups/%s/group-members/%s" % (sso_url, group_name, subname)
-    return requests.request("PUT", url, headers=headers, json=member_msg, params=None)
+    return session.request("PUT", url, headers=headers, json=member_msg, params=None)
 
 
-def add_sso_groups(sso_url, token, check_all):
+def list_sso_groups(session, sso_url, token):
+    """names of the groups existing in sso, None if they can not be listed"""
+    headers = {"Accept": "application/json", 'Authorization': 'Bearer %s' % token}
+    try:
+        req = session.get("%s/api/groups/" % sso_url, headers=headers, verify=False)
+        groups = req.json() if req.status_code == 200 else None
+    except (requests.RequestException, ValueError) as e:
+        warn("list sso groups wrong: %s" % e)
+        return None
+    if isinstance(groups, dict):
+        groups = groups.get('groups', groups.get('results'))
+    if not isinstance(groups, list):
+        warn("list sso groups wrong: %s" % req.text.encode('utf8'))
+        return None
+    return set(g['name'] if isinstance(g, dict) else g for g in groups)
+
+
+def add_sso_groups(sso_url, token, check_all, concurrency=SSO_CONCURRENCY, rate=SSO_RATE):
     if not check_all:
         appnames = ['console', 'registry', 'tinydns', 'webrouter', 'lvault']
         get_apps_success = True
@@ -145,28 +160,48 @@ def add_sso_groups(sso_url, token, check_all):
         get_apps_success, appnames = get_console_apps(token)
     if not get_apps_success:
         return
-    for app in appnames:
+
+    domain = get_console_domain()
+    session = pooled_session(concurrency)
+    limiter = RateLimiter(rate, burst=concurrency)
+    existing = list_sso_groups(session, sso_url, token)
+    if existing is not None:
+        missing = [app for app in appnames
+                   if get_group_name_for_app(app, domain) not in existing]
+        info("%d of %d app groups exist in sso, %d to create" % (
+            len(appnames) - len(missing), len(appnames), len(missing)))
+        appnames = missing
+
+    def add_group(app):
         try:
-            group_name = get_group_name_for_app(app)
-            group_fullname = get_group_fullname_for_app(app)
+            group_name = get_group_name_for_app(app, domain)
+            group_fullname = get_group_fullname_for_app(app, domain)
             group_msg = {'name': group_name, 'fullname': group_fullname}
             headers = {"Content-Type": "application/json",
                        "Accept": "application/json", 'Authorization': 'Bearer %s' % token}
             url = "%s/api/groups/" % sso_url
-            req = requests.request(
+            limiter.acquire()
+            req = session.request(
                 "POST", url, headers=headers, json=group_msg, verify=False)
             if req.status_code == 201:
                 info("successfully create sso group for app %s" % app)
+                limiter.acquire()
                 resp = add_subgroup_for_admin(
-                    sso_url, token, app, "lain", "admin")
+                    sso_url, token, app, "lain", "admin", session, domain)
                 info('add subgroup lain, response code: %s' % resp.status_code)
+                return True
             else:
                 result = req.text
-                print("create sso group for app %s wrong: %s" %
-                      (app, result.encode('utf8')))
-            time.sleep(3)
+                println("create sso group for app %s wrong: %s" %
+                        (app, result.encode('utf8')))
         except Exception as e:
-            print("create sso group for app %s wrong: %s" % (app, e))
+            println("create sso group for app %s wrong: %s" % (app, e))
+        return False
+
+    start = time.time()
+    results = parallel_map(add_group, appnames, concurrency)
+    info("%d sso groups created, %d failures, %.1fs in total" % (
+        results.count(True), results.count(False), time.time() - start))
 
 
 def get_console_apps(token):
@@ -202,8 +237,11 @@ def close_console_auth():
 
 def open_registry_auth(args):
     info("opening registry auth...")
+    realm = args.realm
+    if realm is None:
+        realm = 'http://console.%s/api/v1/authorize/registry/' % get_console_domain()
     auth_setting = '{"realm": "%s", "issuer": "%s", "service": "lain.local"}' % (
-        args.realm, args.issuer)
+        realm, args.issuer)
 
     check_output(['etcdctl', 'set',
                   '/lain/config/auth/registry',
@@ -1,37 +1,58 @@
 # -*- coding: utf-8 -*-
+import importlib
 import logging
+import sys
 import argh
-import os
-from lain_admin_cli.version import version
-from lain_admin_cli.node import Node
-from lain_admin_cli.config import Config
-from lain_admin_cli.cluster import Cluster
-from lain_admin_cli.auth import Auth
-from lain_admin_cli.network import Network
-from lain_admin_cli.drift import drift
-from lain_admin_cli.registry import Registry
-from lain_admin_cli.bootstrap import bootstrap
-from lain_admin_cli.vault import Vault
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("docker").setLevel(logging.WARNING)
 
+# command name -> (module, attribute), modules are only imported when the
+# command is dispatched, so `lainctl version` does not load node or auth
 one_level_commands = [
-    version, drift
+    ('version', ('lain_admin_cli.version', 'version')),
+    ('drift', ('lain_admin_cli.drift', 'drift')),
 ]
 
 two_level_commands = [
-    Node, Cluster, Auth, Network, Registry, Vault
+    ('node', ('lain_admin_cli.node', 'Node')),
+    ('cluster', ('lain_admin_cli.cluster', 'Cluster')),
+    ('auth', ('lain_admin_cli.auth', 'Auth')),
+    ('network', ('lain_admin_cli.network', 'Network')),
+    ('registry', ('lain_admin_cli.registry', 'Registry')),
+    ('vault', ('lain_admin_cli.vault', 'Vault')),
+    ('config', ('lain_admin_cli.config', 'Config')),
 ]
 
 
-def main():
+def _load(location):
+    module, attr = location
+    return getattr(importlib.import_module(module), attr)
+
+
+def _commands_for(argv):
+    """
+    return the one and two level commands needed to dispatch argv,
+    everything when argv does not name a known command (e.g. --help)
+    """
+    name = next((arg for arg in argv if not arg.startswith('-')), None)
+    one_level = [c for c in one_level_commands if c[0] == name]
+    two_level = [c for c in two_level_commands if c[0] == name]
+    if one_level or two_level:
+        return one_level, two_level
+    return one_level_commands, two_level_commands
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    one_level, two_level = _commands_for(argv)
     parser = argh.ArghParser()
-    parser.add_commands(one_level_commands)
-    for command in two_level_commands:
+    parser.add_commands([_load(location) for _, location in one_level])
+    for _, location in two_level:
+        command = _load(location)
         argh.add_commands(parser, command.subcommands(),
                           namespace=command.namespace(), help=command.help_message())
-    parser.dispatch()
+    parser.dispatch(argv=argv)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import sys
 from argh.decorators import arg
 from lain_admin_cli.helpers import info, error, warn
 from lain_admin_cli.helpers import TwoLevelCommandBase, run_ansible_cmd
@@ -21,6 +22,12 @@ class Cluster(TwoLevelCommandBase):
         return "lain cluster maintainance"
 
     @classmethod
-    def health(self):
-        health = ClusterHealth()
-        health.run()
+    @arg('-t', '--timeout', type=float, help="seconds to wait for all the checks")
+    @arg('--json', help="print the report as json")
+    def health(self, timeout=5, json=False):
+        """
+        check etcd, swarm, deployd and console of the cluster concurrently
+        """
+        health = ClusterHealth(timeout)
+        if not health.run(as_json=json):
+            sys.exit(1)
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from argh import CommandError
 from argh.decorators import arg
-from lain_admin_cli.helpers import TwoLevelCommandBase
+from lain_admin_cli.helpers import TwoLevelCommandBase, get_cluster_config
 
 class Config(TwoLevelCommandBase):
 
     @classmethod
     def subcommands(self):
-        return []
+        return [self.get, self.list]
 
     @classmethod
     def namespace(self):
@@ -18,10 +19,36 @@ class Config(TwoLevelCommandBase):
         return "lain config operations"
 
     @classmethod
-    @arg('item')
-    def get(self, item):
+    @arg('item', help="the item under /lain/config, like domain or auth/registry")
+    @arg('--no-cache', help="read etcd even if LAINCTL_CONFIG_CACHE_TTL is set")
+    def get(self, item, no_cache=False):
         """
         get the configuration for given item
         """
-        return "TODO"
-        pass
+        item = item.strip('/')
+        config = get_cluster_config(use_cache=not no_cache)
+        value = config.get(item)
+        if value is not None:
+            print value
+            return
+        items = config.under(item)
+        if not items:
+            raise CommandError("Unknown config item %s" % item)
+        self.__print_items(items)
+
+    @classmethod
+    @arg('--no-cache', help="read etcd even if LAINCTL_CONFIG_CACHE_TTL is set")
+    def list(self, no_cache=False):
+        """
+        list all the configuration items in /lain/config
+        """
+        self.__print_items(get_cluster_config(use_cache=not no_cache).items)
+
+    @classmethod
+    def __print_items(self, items):
+        # The column margin is 2 spaces
+        min_width = 2 + max(4, *(len(k) for k in items)) if items else 6
+        row_fmt = "%-{min_width}s%s".format(min_width=min_width)
+        print row_fmt % ("ITEM", "VALUE")
+        for k in sorted(items):
+            print row_fmt % (k, items[k])
@@ -2,24 +2,49 @@
 
 from argh.decorators import arg
 from lain_admin_cli.helpers import Node, Container, is_backupd_enabled
-from lain_admin_cli.helpers import yes_or_no, info, error, warn, _yellow, volume_dir
+from lain_admin_cli.helpers import yes_or_no, info, error, warn, println, _yellow, volume_dir
+from lain_admin_cli.helpers import get_etcd_client, swarm_api, swarm_events, human_size
+from lain_admin_cli.helpers import run_playbook, enable_ansible_profile
 from subprocess import check_output, check_call, CalledProcessError
-import requests, os, json, time
+from lain_admin_cli.utils.concurrency import parallel_map
+from collections import OrderedDict
+import requests, os, json, re, stat, tempfile, threading, time
+import etcd
+
+pod_groups_key = "/lain/deployd/pod_groups"
+backup_dir = "/mfs/lain/backup"
+DRIFT_TIMEOUT = 600
+DRIFT_CONCURRENCY = int(os.environ.get('DRIFT_CONCURRENCY', 4))
+# a live volume sync pass this small or short is the last one before stopping
+PRECOPY_BYTES = int(os.environ.get('DRIFT_PRECOPY_BYTES', 64 << 20))
+PRECOPY_SECONDS = float(os.environ.get('DRIFT_PRECOPY_SECONDS', 10))
+PRECOPY_PASSES = int(os.environ.get('DRIFT_PRECOPY_PASSES', 5))
+BACKUP_CONCURRENCY = int(os.environ.get('BACKUP_CONCURRENCY', 4))
+# the longest time to block on the events stream before inspecting again
+RUNNING_EVENT_WAIT = 10
 
 
 @arg('-p', '--playbooks', required=True)
 @arg('--with-volume')
 @arg('--ignore-volume')
 @arg('-t', '--target')
+@arg('--timeout', type=int, help="seconds to wait for deployd to drift one container")
+@arg('-c', '--concurrency', type=int, help="number of containers drifted by deployd at the same time")
+@arg('--precopy-passes', type=int,
+     help="max volume sync passes before stopping the containers with --with-volume, 1 to sync once")
+@arg('--ansible-profile', help="report how long every ansible task takes on every host")
 @arg('containers', nargs='+')
-def drift(containers, with_volume=False, ignore_volume=False, playbooks="", target=""):
+def drift(containers, with_volume=False, ignore_volume=False, playbooks="", target="",
+          timeout=DRIFT_TIMEOUT, concurrency=DRIFT_CONCURRENCY, precopy_passes=PRECOPY_PASSES,
+          ansible_profile=False):
+    enable_ansible_profile(ansible_profile)
     if with_volume and ignore_volume:
         error("--with-volume and --ignore-volume is mutual option")
         return
     target = Node(target) if target != "" else None
     try:
         containers = [Container(c) for c in containers]
-        nodes = [Node(c.host) for c in containers]
+        nodes = dict((c.host, Node(c.host)) for c in containers)
     except Exception as e:
             error("Fail to get container or node info, %s" % (str(e)))
             return
@@ -30,27 +55,133 @@ def drift(containers, with_volume=False, ignore_volume=False, playbooks="", targ
     if not yes_or_no("Are you sure?", default='no', color=_yellow):
         return
 
-    for container in containers:
-        if len(container.volumes) > 0:
-            if not (with_volume or ignore_volume):
-                warn("container %s having lain volumes,"
-                     "you may need run `drift --ignore-volume[--with-volume] ...` to drift it,"
-                     "ignore this container." % container.name)
-                continue
-            if not target and with_volume:
-                warn("container %s having lain volumes, target node required to drift with volume." % container.name)
-                warn("run `drift --with-volume -t[--target] somenode ...`")
+    containers = [c for c in containers
+                  if can_drift(c, target, with_volume, ignore_volume)]
+    backupd_enabled = None
+    for host, group in group_by_source(containers):
+        node = nodes[host]
+        drifted = drift_group(node, group, target, playbooks, with_volume,
+                              ignore_volume, timeout, concurrency, precopy_passes)
+        for container in drifted:
+            if len(container.volumes) == 0:
                 continue
+            if backupd_enabled is None:
+                backupd_enabled = is_backupd_enabled()
+            if backupd_enabled:
+                fix_backupd(container, node, target)
+
+
+def can_drift(container, to_node, with_volume, ignore_volume):
+    """check, and confirm if needed, whether container can be drifted"""
+    if len(container.volumes) > 0:
+        if not (with_volume or ignore_volume):
+            warn("container %s having lain volumes,"
+                 "you may need run `drift --ignore-volume[--with-volume] ...` to drift it,"
+                 "ignore this container." % container.name)
+            return False
+        if not to_node and with_volume:
+            warn("container %s having lain volumes, target node required to drift with volume." % container.name)
+            warn("run `drift --with-volume -t[--target] somenode ...`")
+            return False
+
+    if container.appname == 'deploy':
+        key = '/lain/deployd/pod_groups/deploy/deploy.web.web'
+        data = json.loads(check_output(['etcdctl', 'get', key]))
+        if len(data['Pods']) <= 1:
+            warn("Deployd is not HA now, can not drift it."
+                 "you should scale it to 2+ instance first."
+                 "ignore container %s" % container.name)
+            return False
+    elif container.appname == 'webrouter':
+        if not yes_or_no("Make sure %s exist on %s" % (container.info['Config']['Image'],
+                                                       to_node.name if to_node else "the new node"),
+                         default='no', color=_yellow):
+            return False
+    return True
+
 
-        node = Node(container.host)
-        drift_container(node, container, target, playbooks, with_volume, ignore_volume)
-        if len(container.volumes) > 0 and is_backupd_enabled():
-            fix_backupd(container, node, target)
+def group_by_source(containers):
+    """group containers by their node, in the order they are given"""
+    groups = OrderedDict()
+    for container in containers:
+        groups.setdefault(container.host, []).append(container)
+    return groups.items()
+
+
+def drift_group(from_node, containers, to_node, playbooks_path, with_volume, ignore_volume,
+                timeout, concurrency, precopy_passes=PRECOPY_PASSES):
+    """
+    drift containers of the same node with one warm-up and one volume sync,
+    then let deployd drift them concurrently, one instance of a pod group
+    at a time. returns the drifted containers
+    """
+    if to_node:
+        ## Warm-up on target node
+        info("Warm-up %d containers on target node..." % len(containers))
+        warm_up_on_target(playbooks_path, containers, to_node)
+    else:
+        info("No specified target node, skip warm-up...")
+
+    ## Drift volumes
+    with_volumes = [c for c in containers if with_volume and len(c.volumes) > 0]
+    if with_volumes:
+        info("Drift the volume...")
+        precopy_volumes(playbooks_path, with_volumes, from_node, to_node, max(precopy_passes, 1))
+
+        stop_at = time.time()
+        stopped = stop_containers(with_volumes, concurrency)
+        if stopped:
+            info("Drift the volume again...")
+            size = drift_volumes(playbooks_path, stopped, from_node, to_node)
+            info("Final sync: %s in %.1fs" % (
+                "unknown bytes" if size is None else "%d bytes" % size, time.time() - stop_at))
+        containers = [c for c in containers if c not in with_volumes or c in stopped]
+
+    results = map_by_pod(
+        lambda c: drift_container(from_node, c, to_node, with_volume, ignore_volume, timeout),
+        containers, concurrency)
+    if with_volumes:
+        info("Downtime of the containers with volumes: %.1fs" % (time.time() - stop_at))
+    return [c for c, drifted in zip(containers, results) if drifted]
+
+
+def map_by_pod(func, containers, concurrency):
+    """
+    parallel_map func over containers, but the containers of the same pod
+    group run one after another in order, so a proc, deployd included,
+    never loses two instances at once
+    """
+    chains = OrderedDict()
+    for container in containers:
+        chains.setdefault(container.podname, []).append(container)
+    chain_results = parallel_map(lambda chain: [func(c) for c in chain],
+                                 chains.values(), concurrency)
+    results = {}
+    for chain, chain_result in zip(chains.values(), chain_results):
+        for container, result in zip(chain, chain_result):
+            results[id(container)] = result
+    return [results[id(container)] for container in containers]
 
 
-def fix_backupd(container, source, target):
+def stop_containers(containers, concurrency):
+    """stop containers through swarm, returns the stopped ones"""
+    def stop(container):
+        info("Stop the container %s" % container.name)
+        try:
+            check_output(['docker', '-H', 'swarm.lain:2376', 'stop', container.info['Id']])
+        except CalledProcessError:
+            # container may not existed now, removed by deployd, ignore errors
+            error("Fail to stop the container %s" % container.name)
+            return False
+        return True
+    results = parallel_map(stop, containers, concurrency)
+    return [c for c, stopped in zip(containers, results) if stopped]
+
+
+def fix_backupd(container, source, target, concurrency=BACKUP_CONCURRENCY):
+    target_dir = os.path.join(backup_dir, target.ip)
     try:
-        tf = open("/mfs/lain/backup/%s/.meta" % target.ip, 'rb')
+        tf = open(os.path.join(target_dir, ".meta"), 'rb')
     except IOError as e:
         target_meta = {}
     else:
@@ -58,41 +189,138 @@ def fix_backupd(container, source, target):
         tf.close()
 
     try:
-        sf = open("/mfs/lain/backup/%s/.meta" % source.ip, 'rb')
+        sf = open(os.path.join(backup_dir, source.ip, ".meta"), 'rb')
     except IOError as e:
         return # backup file do not exist
     else:
         source_meta = json.loads(sf.read())
         sf.close()
 
+    items = [(volume, item) for volume in container.volumes
+             for item in source_meta.get(volume, None) or []]
+    if not items:
+        return
+    try:
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+    except OSError as e:
+        error(str(e))
+        warn("Fail to create backup dir on target node %s, check this by hand" % target.ip)
+        return
+
+    progress = BackupProgress(len(items))
+
+    def relocate(volume_item):
+        name = volume_item[1]['name']
+        source_file = os.path.join(backup_dir, source.ip, name)
+        target_file = os.path.join(target_dir, name)
+        size, mtime = backup_stat(source_file)
+        if size is not None and (size, mtime) == backup_stat(target_file):
+            progress.done(name, size, skipped=True)
+            return True
+        try:
+            # -a keeps the mtime for the next comparison, -T copies a
+            # directory onto an existing one instead of into it
+            check_call(['cp', '-a', '-T', source_file, target_file])
+        except CalledProcessError as e:
+            error(str(e))
+            warn("You may need to move %s to %s by hands" % (source_file, target_file))
+            progress.done(name, 0, failed=True)
+            return False
+        progress.done(name, size)
+        return True
+
+    results = parallel_map(relocate, items, concurrency)
+    progress.summary()
+
     changed = False
     for volume in container.volumes:
-        data = source_meta.get(volume, None)
-        if not data:
-            continue
-        target_meta[volume] = []
-        for item in data:
-            info("Fix backup for %s" % item['name'])
-            source_file = "/mfs/lain/backup/%s/%s" % (source.ip, item['name'])
-            target_file = "/mfs/lain/backup/%s/%s" % (target.ip, item['name'])
-            try:
-                cmd = 'mkdir -p /mfs/lain/backup/%s && cp -r %s %s' % (target.ip, source_file, target_file)
-                check_call(['/bin/bash', '-c', cmd])
-            except CalledProcessError as e:
-                error(str(e))
-                warn("You may need to move %s to %s by hands" % (source_file, target_file))
-                continue
-            else:
-                target_meta[volume].append(item)
-                changed = True
+        if source_meta.get(volume, None):
+            target_meta[volume] = []
+    for (volume, item), relocated in zip(items, results):
+        if relocated:
+            target_meta[volume].append(item)
+            changed = True
     if changed:
         try:
-            tf = open("/mfs/lain/backup/%s/.meta" % target.ip, 'w+')
-            tf.write(json.dumps(target_meta))
-            tf.close()
-        except IOError as e:
+            write_atomically(os.path.join(target_dir, ".meta"), json.dumps(target_meta))
+        except (IOError, OSError) as e:
             warn(str(e))
-            warn("Fail to create meta on target node, check this by hand" % target.ip)
+            warn("Fail to create meta on target node %s, check this by hand" % target.ip)
+
+
+class BackupProgress(object):
+    """print the progress of relocating backups and the throughput at last"""
+
+    def __init__(self, total):
+        self.total = total
+        self.count = self.copied = self.skipped = self.failed = self.size = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def done(self, name, size, skipped=False, failed=False):
+        with self.lock:
+            self.count += 1
+            if skipped:
+                self.skipped += 1
+                state = "unchanged, skipped"
+            elif failed:
+                self.failed += 1
+                state = "failed"
+            else:
+                self.copied += 1
+                self.size += size
+                state = human_size(size)
+            info("[%d/%d] Fix backup for %s: %s" % (self.count, self.total, name, state))
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        info("Fixed backups: %d copied (%s, %s/s), %d unchanged, %d failed in %.1fs" % (
+            self.copied, human_size(self.size), human_size(self.size / max(elapsed, 0.001)),
+            self.skipped, self.failed, elapsed))
+
+
+def backup_stat(path):
+    """
+    (size, mtime) of a backup file, or the total size and the latest file
+    mtime of a backup directory, (None, None) if it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    if not os.path.isdir(path):
+        return st.st_size, int(st.st_mtime)
+    size, mtime = 0, 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except OSError:
+                continue
+            size += st.st_size
+            mtime = max(mtime, int(st.st_mtime))
+    return size, mtime
+
+
+def write_atomically(path, content):
+    """
+    write content into a temp file beside path, then rename it to path,
+    keeping the mode of path (mkstemp creates the temp file 0600)
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0644
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.meta.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
 
 
 def drift_volumes(playbooks_path, containers, source, target):
@@ -103,96 +331,205 @@ def drift_volumes(playbooks_path, containers, source, target):
     with open(var_file, 'wb') as f:
         f.write('{"volumes":%s,"ids":"%s"}'%(json.dumps(volumes), ' '.join(ids)))
 
-    cmd = ['ansible-playbook', '-i', os.path.join(playbooks_path, 'cluster')]
-    cmd += ['-e', 'target=nodes']
-    cmd += ['-e', 'target_node=%s'%target.name]
-    cmd += ['-e', 'from_node=%s'%source.name]
-    cmd += ['-e', 'from_ip=%s'%source.ip]
-    cmd += ['-e', 'role=drift']
-    cmd += ['-e', 'var_file=%s'%var_file]
-    cmd += [os.path.join(playbooks_path, 'role.yaml')]
-    info('cmd is: %s', ' '.join(cmd))
-    check_call(cmd)
+    extra_vars = ['target=nodes']
+    extra_vars += ['target_node=%s'%target.name]
+    extra_vars += ['from_node=%s'%source.name]
+    extra_vars += ['from_ip=%s'%source.ip]
+    extra_vars += ['role=drift']
+    extra_vars += ['var_file=%s'%var_file]
+    extra_vars += ['rsync_opts=--stats']
+    # -v prints the registered rsync output, which has the --stats report
+    output = run_playbook(playbooks_path, extra_vars, capture=True, verbose=True,
+                          label='drift')
     os.remove(var_file)
+    return transferred_bytes(output)
+
+
+def transferred_bytes(output):
+    """
+    sum the "Total transferred file size" of the rsync --stats reports in
+    output, None if there is no report. a task result printed by ansible -v
+    has the report in both stdout and stdout_lines, only stdout is counted
+    """
+    sizes = []
+    for line in output.splitlines():
+        m = re.match(r'(?:ok|changed): \[[^\]]*\].*? => (\{.*\})\s*$', line)
+        if m:
+            try:
+                result = json.loads(m.group(1))
+            except ValueError:
+                result = None
+            if isinstance(result, dict):
+                line = result.get('stdout') or ''
+        sizes += re.findall(r'Total transferred file size: ([\d,.]+)([KMGT]?) bytes', line)
+    if not sizes:
+        return None
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    return sum(int(float(n.replace(',', '')) * units[u]) for n, u in sizes)
+
+
+def precopy_volumes(playbooks_path, containers, source, target, max_passes):
+    """
+    sync the volumes while containers are running, again and again until a
+    pass transfers less than PRECOPY_BYTES or takes less than
+    PRECOPY_SECONDS, so that the final sync after stopping is short. only
+    one pass is made when the playbook reports no rsync stats
+    """
+    last = None
+    for n in range(1, max_passes + 1):
+        start = time.time()
+        size = drift_volumes(playbooks_path, containers, source, target)
+        elapsed = time.time() - start
+        info("Pre-copy pass %d: %s in %.1fs" % (
+            n, "unknown bytes" if size is None else "%d bytes" % size, elapsed))
+        if size is None:
+            # without byte counts there is nothing to converge on, keep the
+            # single pass instead of repeating full live syncs
+            warn("The drift playbook printed no rsync stats, stop pre-copy after one pass")
+            break
+        if elapsed <= PRECOPY_SECONDS or size <= PRECOPY_BYTES:
+            break
+        if last is not None and size >= last:
+            warn("Pre-copy does not converge, stop the containers anyway")
+            break
+        last = size
 
 
 def warm_up_on_target(playbooks_path, containers, target):
     to_drift_images = reduce(lambda x, y: x + [y.info['Config']['Image']],
                              containers, [])
 
-    cmd = ['ansible-playbook', '-i', os.path.join(playbooks_path, 'cluster')]
-    cmd += ['-e', 'target=nodes']
-    cmd += ['-e', 'target_node=%s' % target.name]
-    cmd += ['-e', 'role=drift-warm-up']
-    cmd += ['-e', 'to_drift_images=%s' % to_drift_images]
-    cmd += [os.path.join(playbooks_path, 'role.yaml')]
-    info('cmd is: %s', ' '.join(cmd))
-    check_call(cmd)
+    extra_vars = ['target=nodes']
+    extra_vars += ['target_node=%s' % target.name]
+    extra_vars += ['role=drift-warm-up']
+    extra_vars += ['to_drift_images=%s' % to_drift_images]
+    run_playbook(playbooks_path, extra_vars, label='drift-warm-up')
 
 
-def drift_container(from_node, container, to_node, playbooks_path, with_volume, ignore_volume):
-    if container.appname == 'deploy':
-        key = '/lain/deployd/pod_groups/deploy/deploy.web.web'
-        data = json.loads(check_output(['etcdctl', 'get', key]))
-        if len(data['Pods']) <= 1:
-            warn("Deployd is not HA now, can not drift it."
-                 "you should scale it to 2+ instance first."
-                 "ignore container %s" % container.name)
-            return
-    elif container.appname == 'webrouter':
-        if not yes_or_no("Make sure %s exist on %s" % (container.info['Config']['Image'], to_node.name),
-                         default='no', color=_yellow):
-            return
-
+def drift_container(from_node, container, to_node, with_volume, ignore_volume,
+                    timeout=DRIFT_TIMEOUT):
     url = "http://deployd.lain:9003/api/nodes?cmd=drift&from=%s&pg=%s&pg_instance=%s" % (
         from_node.name, container.podname, container.instance
     )
     url += "&force=true" if with_volume or ignore_volume else ""
     url += "&to=%s" % to_node.name if to_node else ""
 
-    if to_node:
-        ## Warm-up on target node
-        info("Warm-up on target node...")
-        warm_up_on_target(playbooks_path, [container], to_node)
-    else:
-        info("No specified target node, skip warm-up...")
-
-    ## Drift volumes
-    if with_volume and len(container.volumes) > 0:
-        info("Drift the volume...")
-        drift_volumes(playbooks_path, [container], from_node, to_node)
-
-        info("Stop the container %s" % container.name)
-        try:
-            check_output(['docker', '-H', 'swarm.lain:2376', 'stop', container.info['Id']])
-        except CalledProcessError:
-            # container may not existed now, removed by deployd, ignore errors
-            error("Fail to stop the container %s" % container.name)
-            return
-
-        info("Drift the volume again...")
-        drift_volumes(playbooks_path, [container], from_node, to_node)
-
     ## Call deployd api
     info("PATCH %s" % url)
     resp = requests.patch(url)
     if resp.status_code >= 300:
         error("Deployd drift api response a error, %s." % resp.text)
+        return False
 
     ## waiting for deployd complete
     drifted_container_name = "%s.%s.%s.v%s-i%s-d%s" % (
         container.appname, container.proctype, container.procname,
         container.version, container.instance, container.drift+1
     )
-    print(">>>(need some minutes)Waiting for deployd drift %s to %s..." % (container.name, drifted_container_name))
+    println(">>>(need some minutes)Waiting for deployd drift %s to %s..." % (container.name, drifted_container_name))
+    new_container = wait_drifted(container, drifted_container_name, timeout)
+    if new_container is None:
+        return False
+    info("%s/%s => %s%s drifted success" % (container.host, container.name,
+                                            new_container['Node']['Name'],
+                                            new_container['Name']))
+    return True
+
+
+def wait_drifted(container, drifted_name, timeout):
+    """
+    wait until deployd schedules the drifted pod instance and then until
+    swarm runs its container, the two durations are reported separately.
+    returns the detail of the drifted container, None on timeout
+    """
+    start = time.time()
+    deadline = start + timeout
+    if not wait_scheduled(container, deadline):
+        error("Deployd did not schedule %s in %ds" % (drifted_name, timeout))
+        return None
+    scheduled = time.time()
+    info("%s scheduled by deployd in %.1fs" % (drifted_name, scheduled - start))
+    detail = wait_running(drifted_name, deadline)
+    if detail is None:
+        error("%s is not running in %ds" % (drifted_name, timeout))
+        return None
+    info("%s running in %.1fs (%.1fs after scheduled)" % (
+        drifted_name, time.time() - start, time.time() - scheduled))
+    return detail
+
+
+def is_drifted_pod(pod_group, container):
+    """whether deployd drifted the pod instance of container in pod_group"""
+    for pod in pod_group.get('Pods') or []:
+        if pod.get('InstanceNo') == container.instance:
+            return pod.get('DriftCount', 0) > container.drift
+    return False
+
+
+def wait_scheduled(container, deadline):
+    """watch the pod group of container in etcd until its drift count increases"""
+    key = "%s/%s/%s" % (pod_groups_key, container.appname, container.podname)
+    client = get_etcd_client()
+    index = None
+    while time.time() < deadline:
+        try:
+            if index is None:
+                result = client.read(key)
+                index = result.etcd_index + 1
+            else:
+                result = client.watch(key, index=index, timeout=deadline - time.time())
+                index = result.modifiedIndex + 1
+        except etcd.EtcdWatchTimedOut:
+            return False
+        except etcd.EtcdEventIndexCleared:
+            # missed too many changes, read the key again
+            index = None
+            continue
+        except etcd.EtcdException as e:
+            info('watch %s with err:%s' % (key, e))
+            index = None
+            time.sleep(1)
+            continue
+        if result.value and is_drifted_pod(json.loads(result.value), container):
+            return True
+    return False
+
+
+def inspect_swarm_container(name):
+    try:
+        resp = requests.get(swarm_api + '/containers/%s/json' % name, timeout=10)
+    except requests.exceptions.RequestException as e:
+        info('inspect %s with err:%s' % (name, e))
+        return None
+    return resp.json() if resp.status_code == 200 else None
+
+
+def wait_running(name, deadline):
+    """wait for the start event of the container until swarm reports it running"""
+    filters = {'type': ['container'], 'event': ['start'], 'container': [name]}
     while True:
+        wait = deadline - time.time()
+        events = None
+        if wait > 0:
+            try:
+                # subscribe before inspecting, so a start in between is not missed
+                events = swarm_events(filters, min(wait, RUNNING_EVENT_WAIT))
+            except requests.exceptions.RequestException as e:
+                info('wait events of %s with err:%s' % (name, e))
         try:
-            output = check_output(['docker', '-H', 'swarm.lain:2376', 'inspect', drifted_container_name])
-        except CalledProcessError:
-            time.sleep(3)
-        else:
-            new_container = json.loads(output)[0]
-            info("%s/%s => %s%s drifted success" % (container.host, container.name,
-                                                    new_container['Node']['Name'],
-                                                    new_container['Name']))
-            break
+            detail = inspect_swarm_container(name)
+            if detail and detail['State'].get('Running'):
+                return detail
+            if wait <= 0:
+                return None
+            if events is None:
+                time.sleep(min(1, max(deadline - time.time(), 0)))
+                continue
+            for _ in events:
+                break
+        except requests.exceptions.RequestException as e:
+            info('wait events of %s with err:%s' % (name, e))
+            time.sleep(min(1, max(deadline - time.time(), 0)))
+        finally:
+            if events is not None:
+                events.close()
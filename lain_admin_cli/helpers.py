@@ -1,18 +1,38 @@
 # -*- coding: utf-8 -*-
 
 import getpass
+import etcd
 import requests
-from subprocess import check_output, check_call, CalledProcessError, STDOUT
+from subprocess import check_output, check_call, CalledProcessError, Popen, PIPE, STDOUT
 from abc import ABCMeta, abstractmethod
-import os, json
+import os, json, sys, threading
 from urlparse import urlparse, parse_qs
 from urllib import urlencode
+from lain_admin_cli.utils.cache import JsonCache
+from lain_admin_cli.utils.ansible_profile import (
+    execution_env as ansible_execution_env,
+    profile_env as ansible_profile_env, write_report as write_profile_report
+)
 
 requests.packages.urllib3.disable_warnings()
 playbooks_path = ""
 volume_dir = "/data/lain/volumes"
 rsync_secrets_file = "/etc/rsyncd.secrets"
 logs_dir = "/lain/logs"
+nodes_key = "/lain/nodes"
+config_key = "/lain/config"
+# seconds /lain/config is kept on disk between commands, 0 to read it every time
+config_cache_ttl = int(os.environ.get("LAINCTL_CONFIG_CACHE_TTL", 0))
+etcd_authority = os.environ.get("ETCD_AUTHORITY", "etcd.lain:4001")
+ssh_key = "/root/.ssh/lain"
+# connections to the same node are multiplexed over one master connection,
+# the sockets live in a directory only the current user can enter
+ssh_control_dir = os.path.expanduser("~/.ssh/lainctl-cm")
+swarm_api = "http://swarm.lain:2376"
+# set by the --ansible-profile of commands, see enable_ansible_profile
+ansible_profile = False
+# worker threads share stdout, see println
+_stdout_lock = threading.Lock()
 
 
 class TwoLevelCommandBase(object):
@@ -51,18 +71,147 @@ class Node(object):
     def __init__(self, nodename=""):
         if nodename == "":
             return
-        output = check_output(['etcdctl', 'ls', '/lain/nodes/nodes'])
+        node = get_inventory().by_name.get(nodename)
+        if node is None:
+            raise(Exception("unkown nodename %s" % nodename))
+        self.__dict__.update(node.__dict__)
 
-        for line in output.splitlines():
-            if nodename == line.split('/')[-1].split(':')[0]:
-                output = check_output(['etcdctl', 'get', line]).strip()
-                dic = json.loads(output)
-                self.name = nodename
-                self.ip = dic['ip']
-                self.ssh_port = int(dic['ssh_port'])
-                self.docker_device = dic['docker_device']
-                return
-        raise(Exception("unkown nodename %s" % nodename))
+    @property
+    def key(self):
+        return "%s:%s:%s" % (self.name, self.ip, self.ssh_port)
+
+    @classmethod
+    def from_etcd(cls, key, value):
+        node = cls()
+        node.name, node.ip, node.ssh_port = key.split(':')
+        node.ssh_port = int(node.ssh_port)
+        try:
+            dic = json.loads(value)
+        except (TypeError, ValueError):
+            return node
+        node.ip = dic.get('ip', node.ip)
+        node.ssh_port = int(dic.get('ssh_port', node.ssh_port))
+        node.docker_device = dic.get('docker_device', "")
+        return node
+
+
+class NodeInventory(object):
+    """
+    a snapshot of /lain/nodes read with one recursive etcd request,
+    nodes are indexed by name and ip, and every group (nodes, managers,
+    etcd-members, swarm-managers, ...) by the member node names
+    """
+
+    def __init__(self, client=None):
+        self.by_name = {}
+        self.by_ip = {}
+        self.groups = {}
+        client = client or get_etcd_client()
+        try:
+            result = client.read(nodes_key, recursive=True)
+        except etcd.EtcdKeyNotFound:
+            return
+        for leaf in result.leaves:
+            parts = leaf.key[len(nodes_key) + 1:].split('/')
+            if leaf.dir or len(parts) != 2:
+                continue
+            group, key = parts
+            self.groups.setdefault(group, {})[key.split(':')[0]] = key
+            if group == 'nodes':
+                node = Node.from_etcd(key, leaf.value)
+                self.by_name[node.name] = node
+                self.by_ip[node.ip] = node
+        for node in self.by_name.values():
+            node.is_lain_manager = self.in_group('managers', node.name)
+            node.is_etcd_member = self.in_group('etcd-members', node.name)
+            node.is_swarm_manager = self.in_group('swarm-managers', node.name)
+
+    def nodes(self):
+        return sorted(self.by_name.values(), key=lambda n: n.name)
+
+    def find(self, name_or_ip):
+        return self.by_name.get(name_or_ip) or self.by_ip.get(name_or_ip)
+
+    def group(self, group):
+        """return {node name: etcd key} of the group"""
+        return self.groups.get(group, {})
+
+    def in_group(self, group, nodename):
+        return nodename in self.group(group)
+
+
+_inventory = None
+
+
+def get_inventory(refresh=False):
+    """the NodeInventory shared by the whole command"""
+    global _inventory
+    if _inventory is None or refresh:
+        _inventory = NodeInventory()
+    return _inventory
+
+
+class ClusterConfig(object):
+    """
+    a snapshot of /lain/config read with one recursive etcd request, items
+    are keyed by their path under /lain/config, like domain or auth/registry
+    """
+
+    def __init__(self, client=None, items=None):
+        self.items = items
+        if items is not None:
+            return
+        self.items = {}
+        client = client or get_etcd_client()
+        try:
+            result = client.read(config_key, recursive=True)
+        except etcd.EtcdKeyNotFound:
+            return
+        for leaf in result.leaves:
+            if leaf.dir or not leaf.key.startswith(config_key + '/'):
+                continue
+            self.items[leaf.key[len(config_key) + 1:]] = leaf.value
+
+    def get(self, item, default=None):
+        return self.items.get(item, default)
+
+    def under(self, prefix):
+        """return {item: value} of the items under prefix"""
+        prefix = prefix.rstrip('/') + '/'
+        return dict((k, v) for k, v in self.items.items() if k.startswith(prefix))
+
+    @property
+    def domain(self):
+        return self.get('domain')
+
+    @property
+    def console_domain(self):
+        """the first extra domain if there is one, else the domain"""
+        try:
+            return json.loads(self.get('extra_domains'))[0]
+        except (TypeError, ValueError, IndexError, KeyError):
+            return self.domain
+
+
+_configs = {}
+
+
+def get_cluster_config(authority=etcd_authority, refresh=False, use_cache=True):
+    """
+    the ClusterConfig shared by the whole command, it may come from the
+    on-disk cache when LAINCTL_CONFIG_CACHE_TTL is set
+    """
+    if authority in _configs and not refresh:
+        return _configs[authority]
+    disk = JsonCache('config', ttl=config_cache_ttl, max_entries=16,
+                     enabled=use_cache and config_cache_ttl > 0)
+    items = None if refresh else disk.get(authority)
+    config = ClusterConfig(get_etcd_client(authority) if items is None else None, items)
+    if items is None:
+        disk.set(authority, config.items)
+        disk.save()
+    _configs[authority] = config
+    return config
 
 
 class Container(object):
@@ -79,6 +228,7 @@ class Container(object):
     host = ""
 
     def __init__(self, name):
+        self.volumes = []
         try:
             output = check_output(['docker', '-H', 'swarm.lain:2376',
                                    'inspect', "%s" % (name)])
@@ -201,13 +351,64 @@ def sso_login(sso_url, cid, secret, redirect_uri):
     return True, access_token
 
 
-def run_ansible_cmd(playbooks_path, envs, file_name='role.yaml'):
+def enable_ansible_profile(enabled=True):
+    """report the time of every task and host of the following ansible runs"""
+    global ansible_profile
+    ansible_profile = enabled
+
+
+def run_playbook(playbooks_path, extra_vars, file_name='role.yaml', forks=None,
+                 capture=False, verbose=False, label=None):
+    """
+    run a playbook of playbooks_path on its cluster inventory, extra_vars
+    are the values given by -e, verbose runs it with -v to print the task
+    results. raises CalledProcessError if it fails, returns the output if
+    capture, which is printed as it goes as well.
+    """
     cmd = ['ansible-playbook', '-i', os.path.join(playbooks_path, 'cluster')]
-    cmd += ['-e', json.dumps(envs)]
+    for v in extra_vars:
+        cmd += ['-e', v]
+    if forks:
+        cmd += ['-f', str(forks)]
+    if verbose:
+        cmd += ['-v']
     cmd += [os.path.join(playbooks_path, file_name)]
     info('cmd is: %s', ' '.join(cmd))
+
+    env, profile = os.environ.copy(), None
+    env.update(ansible_execution_env())
+    if ansible_profile:
+        extra_env, profile = ansible_profile_env(label or os.path.splitext(file_name)[0])
+        env.update(extra_env)
     try:
-        check_call(cmd)
+        if capture:
+            return _run_and_capture(cmd, env)
+        check_call(cmd, env=env)
+    finally:
+        if profile:
+            lines = write_profile_report(profile)
+            if lines is None:
+                warn("ansible did not write the profile %s", profile)
+            else:
+                info("ansible profile, saved in %s:\n%s", profile, '\n'.join(lines))
+
+
+def _run_and_capture(cmd, env=None):
+    p = Popen(cmd, stdout=PIPE, stderr=STDOUT, env=env)
+    lines = []
+    for line in iter(p.stdout.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        lines.append(line)
+    if p.wait() != 0:
+        raise CalledProcessError(p.returncode, cmd)
+    return ''.join(lines)
+
+
+def run_ansible_cmd(playbooks_path, envs, file_name='role.yaml', forks=None):
+    try:
+        run_playbook(playbooks_path, [json.dumps(envs)], file_name, forks,
+                     label=envs.get('role'))
     except CalledProcessError:
         error("ansible-playbook failed to run.")
         error("If you see some nodes unreachable, try run this commond first and retry:\n"
@@ -215,31 +416,110 @@ def run_ansible_cmd(playbooks_path, envs, file_name='role.yaml'):
               "    (replace NODE_IP with failed node's IP)")
         return 1
 
+def get_etcd_client(etcd_authority=etcd_authority):
+    etcd_host_and_port = etcd_authority.split(":")
+    if len(etcd_host_and_port) == 2:
+        return etcd.Client(host=etcd_host_and_port[0], port=int(etcd_host_and_port[1]))
+    elif len(etcd_host_and_port) == 1:
+        return etcd.Client(host=etcd_host_and_port[0], port=4001)
+    else:
+        raise Exception("invalid ETCD_AUTHORITY : %s" % etcd_authority)
+
+def ssh_control_path():
+    try:
+        os.makedirs(ssh_control_dir, 0700)
+    except OSError:
+        # created already, possibly by another worker thread
+        if not os.path.isdir(ssh_control_dir):
+            raise
+    os.chmod(ssh_control_dir, 0700)
+    return os.path.join(ssh_control_dir, "%r@%h:%p")
+
+def ssh_cmd(ip, port, command, connect_timeout=5):
+    """build a non-interactive ssh command line running command on the node"""
+    cmd = ['ssh', '-i', ssh_key, '-p', str(port),
+           '-o', 'BatchMode=yes',
+           '-o', 'StrictHostKeyChecking=no',
+           '-o', 'ConnectTimeout=%d' % connect_timeout,
+           '-o', 'ControlMaster=auto',
+           '-o', 'ControlPath=%s' % ssh_control_path(),
+           '-o', 'ControlPersist=60s',
+           'root@%s' % ip]
+    return cmd + [command]
+
+class SwarmEvents(object):
+    """
+    the swarm events matching filters, subscribed on creation so that no
+    event after it is missed. iterating yields the events as they happen,
+    the stream ends when no event arrives in timeout seconds
+    """
+
+    def __init__(self, filters, timeout):
+        self.resp = requests.get(swarm_api + '/events',
+                                 params={'filters': json.dumps(filters)},
+                                 stream=True, timeout=(5, timeout))
+
+    def __iter__(self):
+        try:
+            for line in self.resp.iter_lines(chunk_size=1):
+                if line:
+                    yield json.loads(line)
+        except requests.exceptions.ConnectionError as e:
+            # requests reports a read timeout of the stream as connection error
+            if 'timed out' not in str(e):
+                raise
+        finally:
+            self.close()
+
+    def close(self):
+        self.resp.close()
+
+
+def swarm_events(filters, timeout):
+    """subscribe to the swarm events matching filters, see SwarmEvents"""
+    return SwarmEvents(filters, timeout)
+
+
 def get_rsyncd_secrets():
     with open(rsync_secrets_file) as f:
         secrets = f.read().split(':')[-1]
     return secrets
 
 def get_domain():
-    return check_output(['etcdctl', 'get', '/lain/config/domain']).strip()
+    return get_cluster_config().domain
 
 def is_backupd_enabled():
     try:
-        output = check_output(['etcdctl', 'get', '/lain/config/backup_enabled'], stderr=STDOUT).strip()
-    except CalledProcessError:
+        return get_cluster_config().get('backup_enabled') == 'true'
+    except etcd.EtcdException:
         return False
-    else:
-        return output == 'true'
 
 
+def human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fTB" % size
+
+
+def println(text):
+    """
+    print text as one line, unlike the print statement the line and its
+    newline are written at once, so lines of worker threads never mix
+    """
+    with _stdout_lock:
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
+
 def info(pattern, *args):
-    print(_green(">>> " + pattern % args))
+    println(_green(">>> " + pattern % args))
 
 def error(pattern, *args):
-    print(_red(">>> " + pattern % args, True))
+    println(_red(">>> " + pattern % args, True))
 
 def warn(pattern, *args):
-    print(_yellow(">>> " + pattern % args, True))
+    println(_yellow(">>> " + pattern % args, True))
 
 def yes_or_no(prompt, default='yes', color=None):
     if default not in ('yes', 'no'):
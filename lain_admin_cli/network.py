@@ -3,7 +3,7 @@
 import sys
 from argh.decorators import arg, expects_obj
 from lain_admin_cli.helpers import (
-    TwoLevelCommandBase, run_ansible_cmd, warn, error
+    TwoLevelCommandBase, run_ansible_cmd, warn, error, enable_ansible_profile
 )
 
 
@@ -30,10 +30,13 @@ class Network(TwoLevelCommandBase):
                             when recovering portal, the procname is normally like: portal-{service_name}")
     @arg('-i', '--instance_number', help='Instance number, defined when the recover container is not portal')
     @arg('-c', '--client_app', help='Client appname of the recover service, defined when the recover container is portal')
+    @arg('--ansible-profile', action='store_true', default=False,
+         help="report how long every ansible task takes on every host")
     def recover(self, args):
         """
         network recover will fix docker network issues about container endpoint already exist;
         """
+        enable_ansible_profile(args.ansible_profile)
         if not args.instance_number and not args.client_app:
             error('need defining instance number with -i, or client app with -c')
             sys.exit(1)
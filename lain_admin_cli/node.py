@@ -5,16 +5,28 @@ from argh.decorators import arg, expects_obj
 from lain_admin_cli.helpers import Node as NodeInfo
 from lain_admin_cli.helpers import (
     yes_or_no, info, warn, error, RemoveException, AddNodeException, _yellow,
-    TwoLevelCommandBase, run_ansible_cmd
+    TwoLevelCommandBase, run_ansible_cmd, get_inventory, swarm_api, swarm_events,
+    ssh_cmd, enable_ansible_profile
 )
+from lain_admin_cli.utils.concurrency import parallel_map
 from subprocess import check_output, check_call, Popen, STDOUT, PIPE
 import requests
 import signal
 import json
 import os
+import pipes
 import sys
 import time
-from lain_admin_cli.utils.health import NodeHealth
+from lain_admin_cli.utils.health import NodeHealth, FleetHealth
+
+ADD_NODE_CONCURRENCY = int(os.environ.get('ADD_NODE_CONCURRENCY', 16))
+# nodes cleaned by one ansible run, it caps the image pruning io of the cluster
+CLEAN_BATCH_SIZE = int(os.environ.get('CLEAN_BATCH_SIZE', 10))
+# free space a new node needs on /, in MB
+ADD_NODE_MIN_FREE_MB = int(os.environ.get('ADD_NODE_MIN_FREE_MB', 5120))
+DRAIN_TIMEOUT = 1800
+# the longest time to block on the events stream before counting again
+DRAIN_EVENT_WAIT = 30
 
 
 def sigint_handler(signum, frame):
@@ -39,27 +51,16 @@ class Node(TwoLevelCommandBase):
     def help_message(self):
         return "lain node operations"
 
-    @classmethod
-    def __list_node_group(self, group):
-        output = check_output(['etcdctl', 'ls', '/lain/nodes/%s' % group])
-        nodes = {}
-        for line in output.splitlines():
-            tmp = NodeInfo()
-            tmp.name, tmp.ip, tmp.ssh_port = line.split('/')[-1].split(':')
-            nodes[tmp.name] = tmp
-        return nodes
-
     @classmethod
     def list(self):
         """list all the nodes(name and ip) in lain"""
-        check_output(['etcdctl', 'ls', '/lain/nodes/nodes'])
-        nodes = self.__list_node_group('nodes')
+        nodes = get_inventory().nodes()
 
         # The column margin is 2 spaces
-        min_width = 2 + max(8, *(len(node.name) for node in nodes.values()))
+        min_width = 2 + max(8, *(len(node.name) for node in nodes))
         row_fmt = "%-{min_width}s%s".format(min_width=min_width)
         print row_fmt % ("NODENAME", "IP")
-        for node in nodes.values():
+        for node in nodes:
             print row_fmt % (node.name, node.ip)
 
     @classmethod
@@ -69,25 +70,19 @@ class Node(TwoLevelCommandBase):
         inspect a node, nodename or nodeip should be given.
         info is got from etcd.
         """
-        check_output(['etcdctl', 'ls', '/lain/nodes/nodes'])
-        all_nodes = self.__list_node_group('nodes')
-        for item in all_nodes.values():
-            if node == item.name or node == item.ip:
-                etcd_members = self.__list_node_group('etcd-members')
-                swarm_members = self.__list_node_group('swarm-managers')
-                managers = self.__list_node_group('managers')
-                print json.dumps({
-                    "name": item.name,
-                    "ip": item.ip,
-                    "ssh_port": item.ssh_port,
-                    "docker_device": item.docker_device,
-                    "is_lain_managers": node in managers,
-                    "is_etcd_member": node in etcd_members,
-                    "is_swarm_manager": node in swarm_members,
-                    "labels": self.__get_node_labels(item.ip),
-                }, indent=4)
-                return
-        raise CommandError("Unkown node name %s" % node)
+        item = get_inventory().find(node)
+        if item is None:
+            raise CommandError("Unkown node name %s" % node)
+        print json.dumps({
+            "name": item.name,
+            "ip": item.ip,
+            "ssh_port": item.ssh_port,
+            "docker_device": item.docker_device,
+            "is_lain_managers": item.is_lain_manager,
+            "is_etcd_member": item.is_etcd_member,
+            "is_swarm_manager": item.is_swarm_manager,
+            "labels": self.__get_node_labels(item.ip),
+        }, indent=4)
 
     @classmethod
     def __get_node_labels(self, node_ip):
@@ -107,24 +102,34 @@ class Node(TwoLevelCommandBase):
     @arg('-l', '--labels', nargs='+', default="", help="The labels added to docker daemon in the node. [example: disk=ssd]")
     @arg('-d', '--docker-device', default="", help="The block device use for docker's devicemapper storage."
          "docker will run on loop-lvm if this is not given, which is not proposed")
+    @arg('-c', '--concurrency', type=int, default=ADD_NODE_CONCURRENCY,
+         help="number of nodes prepared and registered at the same time")
+    @arg('--ansible-profile', action='store_true', default=False,
+         help="report how long every ansible task takes on every host")
     def add(self, args):
         """add a new node to lain"""
+        enable_ansible_profile(args.ansible_profile)
+        registered = []
         try:
-            nodes = dict()
             nodes = self.__check_nodes_validation(args.nodes)
 
             port = args.ssh_port
-            for name, ip in nodes:
+            self.__prepare_nodes(nodes, port, args.docker_device, args.concurrency)
+
+            def register(node):
+                name, ip = node
                 check_call(['etcdctl', 'set',
                             '/lain/nodes/new/%s:%s:%s' % (name, ip, port),
                             ip])
-                copy_public_key(ip)
+                registered.append(node)
+            parallel_map(register, nodes, args.concurrency)
 
             if run_addnode_ansible(args):
                 error("run add node ansible failed")
                 return
 
-            for name, ip in nodes:
+            def add_node(node):
+                name, ip = node
                 node_data = json.dumps({'name': name,
                                         'ip': ip,
                                         'ssh_port': port,
@@ -132,12 +137,33 @@ class Node(TwoLevelCommandBase):
                 check_call(['etcdctl', 'set',
                             '/lain/nodes/nodes/%s:%s:%s' % (name, ip, port),
                             node_data])
+            parallel_map(add_node, nodes, args.concurrency)
         except Exception as e:
             error(str(e))
         finally:
-            for name, ip in nodes:
-                check_call(
-                    ['etcdctl', 'rm', '/lain/nodes/new/%s:%s:%s' % (name, ip, port)])
+            def unregister(node):
+                check_call(['etcdctl', 'rm', '/lain/nodes/new/%s:%s:%s' % (node[0], node[1], port)])
+            parallel_map(unregister, registered, args.concurrency)
+
+    @classmethod
+    def __prepare_nodes(self, nodes, port, docker_device, concurrency):
+        """
+        make sure the lain key can log in every node and the nodes are
+        ready, before any of them is registered
+        """
+        can_login = parallel_map(lambda node: can_ssh(node[1], port), nodes, concurrency)
+        # ssh-copy-id may ask for the password, so it runs one node at a time
+        for (name, ip), ok in zip(nodes, can_login):
+            if not ok:
+                copy_public_key(ip, port)
+
+        info("Preflight checks of %d nodes...", len(nodes))
+        problems = parallel_map(lambda node: preflight_node(node[1], port, docker_device),
+                                nodes, concurrency)
+        failed = ["%s(%s): %s" % (name, ip, ', '.join(p))
+                  for (name, ip), p in zip(nodes, problems) if p]
+        if failed:
+            raise AddNodeException("preflight checks failed, " + "; ".join(failed))
 
     @classmethod
     def __check_nodes_validation(self, nodes):
@@ -169,35 +195,35 @@ class Node(TwoLevelCommandBase):
     def __check_existing(self, nodes):
         duplicates = set()
 
-        output = check_output(['etcdctl', 'ls', '/lain/nodes/nodes'])
-        for line in output.splitlines():
-            key = line.split('/')[-1]
-            name, ip, port = key.split(':')
-            for node_name, node_ip in nodes:
-                if node_name == name:
-                    duplicates.add(node_name)
-                elif node_ip == ip:
-                    duplicates.add(node_ip)
+        inventory = get_inventory()
+        for node_name, node_ip in nodes:
+            if node_name in inventory.by_name:
+                duplicates.add(node_name)
+            elif node_ip in inventory.by_ip:
+                duplicates.add(node_ip)
 
         return duplicates
 
     @classmethod
     @arg('-p', '--playbooks', required=True)
     @arg('-t', '--target')
+    @arg('--timeout', type=int, help="seconds to wait for deployd to drift the containers of the node")
     @arg('nodename')
-    def remove(self, nodename, target="", playbooks=""):
+    @arg('--ansible-profile', help="report how long every ansible task takes on every host")
+    def remove(self, nodename, target="", playbooks="", timeout=DRAIN_TIMEOUT,
+               ansible_profile=False):
         """
         remove a node in lain, --target is only useful when swarm manager running on this node.
         """
+        enable_ansible_profile(ansible_profile)
         node = NodeInfo(nodename)
-        target = Node(target) if target != "" else None
+        target = NodeInfo(target) if target != "" else None
         key = "%s:%s:%s" % (node.name, node.ip, node.ssh_port)
 
-        output = check_output(
-            ['etcdctl', 'ls', '/lain/nodes/nodes'], stderr=STDOUT)
-        if len(output.splitlines()) == 1:
+        all_nodes = get_inventory().nodes()
+        if len(all_nodes) == 1:
             error("%s is the last node of lain, can not be removed" %
-                  output.splitlines()[0].split('/')[-1])
+                  all_nodes[0].key)
             return
 
         check_output(['etcdctl', 'set', '/lain/nodes/removing/%s' %
@@ -210,7 +236,7 @@ class Node(TwoLevelCommandBase):
                 raise(RemoveException("Action was canceled"))
             # restart a new swarm manager if a swarm mansger on this node
             drift_swarm_manager(playbooks, node, target)
-            remove_node_containers(node.name)
+            remove_node_containers(node.name, timeout)
             if run_removenode_ansible(playbooks):
                 error("run remove node ansible failed")
                 return
@@ -227,20 +253,39 @@ class Node(TwoLevelCommandBase):
 
     @classmethod
     @arg('-p', '--playbooks', required=True)
+    @arg('-b', '--batch-size', type=int, help="max number of nodes cleaned at the same time")
     @arg('nodes', nargs='+')
-    def clean(self, nodes, playbooks=""):
+    @arg('--ansible-profile', help="report how long every ansible task takes on every host")
+    def clean(self, nodes, playbooks="", batch_size=CLEAN_BATCH_SIZE, ansible_profile=False):
         """
         clean node will clean lain node, remove some useless images,
         each container on the node will retain at most 3 latest images on the node.
+        nodes are cleaned in waves of batch-size nodes, one ansible run a wave.
         """
-        for node in nodes:
-            node_info = NodeInfo(node)
-            key = "%s:%s:%s" % (
-                node_info.name, node_info.ip, node_info.ssh_port)
-            check_output(['etcdctl', 'set', '/lain/nodes/clean/%s' % key, node_info.ip],
-                         stderr=STDOUT)
-            run_cleannode_ansible(playbooks)
-            check_output(['etcdctl', 'rm', '/lain/nodes/clean/%s' % key])
+        enable_ansible_profile(ansible_profile)
+        nodes = [NodeInfo(node) for node in nodes]
+        batch_size = max(batch_size, 1)
+        failed = []
+        for i in range(0, len(nodes), batch_size):
+            wave = nodes[i:i + batch_size]
+            info("Cleaning nodes %s", ', '.join(n.name for n in wave))
+            keys = ["%s:%s:%s" % (n.name, n.ip, n.ssh_port) for n in wave]
+            marked = []
+
+            def mark(item):
+                key, node_info = item
+                check_output(['etcdctl', 'set', '/lain/nodes/clean/%s' % key, node_info.ip],
+                             stderr=STDOUT)
+                marked.append(key)
+            try:
+                parallel_map(mark, zip(keys, wave), batch_size)
+                if run_cleannode_ansible(playbooks, forks=len(wave)):
+                    failed.extend(n.name for n in wave)
+            finally:
+                parallel_map(lambda key: check_output(['etcdctl', 'rm', '/lain/nodes/clean/%s' % key]),
+                             marked, batch_size)
+        if failed:
+            error("failed to clean nodes %s", ', '.join(failed))
 
     @classmethod
     @arg('nodename')
@@ -267,9 +312,21 @@ class Node(TwoLevelCommandBase):
             info("%s constraint on node %s success." % (operator, node.name))
 
     @classmethod
-    def health(cls):
-        health = NodeHealth()
-        health.run()
+    @arg('-a', '--all', dest='show_all', help="check every node in lain instead of the local one")
+    @arg('--json', dest='as_json', help="print the report of --all as json")
+    @arg('-t', '--timeout', type=float, help="seconds allowed to check one node with --all")
+    @arg('-c', '--concurrency', help="number of nodes checked at the same time with --all")
+    def health(cls, show_all=False, as_json=False, timeout=10, concurrency=32):
+        """
+        check the lain services of the local node, or of every node with --all
+        """
+        if not show_all:
+            health = NodeHealth()
+            health.run()
+            return
+        health = FleetHealth(get_inventory().nodes(), timeout, concurrency)
+        if not health.run(as_json=as_json):
+            sys.exit(1)
 
     @classmethod
     @arg('nodes', nargs='+')
@@ -277,10 +334,12 @@ class Node(TwoLevelCommandBase):
     @arg('-l', '--labels', nargs='+', type=str, required=True,
          help='the labels to add, for example: k1=v1 k2=v2')
     @arg('-p', '--playbooks', required=True)
-    def change_labels(self, nodes, change_type="", labels=[], playbooks=""):
+    @arg('--ansible-profile', help="report how long every ansible task takes on every host")
+    def change_labels(self, nodes, change_type="", labels=[], playbooks="", ansible_profile=False):
         """
         change labels of nodes, add/delete operations are supported
         """
+        enable_ansible_profile(ansible_profile)
         normlized_labels = {}
         for x in labels:
             ys = x.split('=')
@@ -350,12 +409,12 @@ def run_change_labels_ansible(playbooks_path, change_type, diff_labels):
     return run_ansible_cmd(playbooks_path, envs)
 
 
-def run_cleannode_ansible(playbooks_path):
+def run_cleannode_ansible(playbooks_path, forks=None):
     envs = {
         'target': 'clean_nodes',
         'role': 'node-clean'
     }
-    return run_ansible_cmd(playbooks_path, envs)
+    return run_ansible_cmd(playbooks_path, envs, forks=forks)
 
 
 def run_removenode_ansible(playbooks_path):
@@ -367,14 +426,8 @@ def run_removenode_ansible(playbooks_path):
 
 
 def drift_swarm_manager(playbooks_path, rm_node, target):
-    is_swarm_manager, key = False, "%s:%s:%s" % (
-        rm_node.name, rm_node.ip, rm_node.ssh_port)
-    output = check_output(['etcdctl', 'ls', '/lain/nodes/swarm-managers'])
-    for line in output.splitlines():
-        if line.split('/')[-1] == key:
-            is_swarm_manager = True
-            break
-    if not is_swarm_manager:
+    key = get_inventory().group('swarm-managers').get(rm_node.name)
+    if key is None:
         return
 
     if not target:
@@ -393,7 +446,7 @@ def drift_swarm_manager(playbooks_path, rm_node, target):
     run_ansible_cmd(playbooks_path, envs)
 
 
-def remove_node_containers(nodename):
+def remove_node_containers(nodename, timeout=DRAIN_TIMEOUT):
     url = "http://deployd.lain:9003/api/nodes?node=%s" % nodename
 
     # Call deployd api
@@ -404,24 +457,60 @@ def remove_node_containers(nodename):
 
     # waiting for deployd complete
     print(">>>(need some minutes)Waiting for deployd drift %s's containers" % nodename)
-    while True:
+    if not wait_node_drained(nodename, timeout):
+        raise RemoveException("containers in node %s are not drifted in %ds, "
+                              "check deployd and retry" % (nodename, timeout))
+
+
+def wait_node_drained(nodename, timeout):
+    """
+    wait until swarm has no container (portals excluded) on the node, the
+    containers are counted again whenever the node destroys one
+    """
+    deadline = time.time() + timeout
+    backoff, last_count = 1, None
+    while time.time() < deadline:
+        events = None
         try:
-            output = Popen(['docker', '-H', 'swarm.lain:2376', 'ps',
-                            '-a', '-f', 'node=%s' % nodename, '-f',
-                            'label=com.docker.swarm.id'], stdout=PIPE)
-            exclude_portals = check_output(
-                ['grep', '-v', '.portal.portal'], stdin=output.stdout)
-            containers = len(exclude_portals.splitlines()) - 1
-            if containers > 0:
-                warn("%d containers in node %s need to drift" %
-                     (containers, nodename))
-                time.sleep(3)
-            else:
+            # subscribe before counting, so a destroy in between is not missed
+            wait_until = min(time.time() + DRAIN_EVENT_WAIT, deadline)
+            events = swarm_events({'type': ['container'], 'event': ['destroy']},
+                                  max(wait_until - time.time(), 0.1))
+            count = count_node_containers(nodename)
+            if count == 0:
                 info("all containers in node %s drifted successed" % nodename)
-                break
+                return True
+            if count != last_count:
+                warn("%d containers in node %s need to drift" % (count, nodename))
+                last_count = count
+            wait_node_event(events, nodename, wait_until)
+            backoff = 1
         except Exception as e:
             info('check containers info with err:%s' % e)
-            time.sleep(3)
+            time.sleep(max(min(backoff, deadline - time.time()), 0))
+            backoff = min(backoff * 2, DRAIN_EVENT_WAIT)
+        finally:
+            if events is not None:
+                events.close()
+    return False
+
+
+def count_node_containers(nodename):
+    filters = json.dumps({'node': [nodename], 'label': ['com.docker.swarm.id']})
+    resp = requests.get(swarm_api + '/containers/json',
+                        params={'all': 1, 'filters': filters}, timeout=10)
+    resp.raise_for_status()
+    return len([c for c in resp.json()
+                if not any('.portal.portal' in name for name in c.get('Names') or [])])
+
+
+def wait_node_event(events, nodename, deadline):
+    """block until events has a container of the node destroyed, at most until deadline"""
+    for event in events:
+        if (event.get('node') or {}).get('Name') == nodename:
+            return
+        if time.time() >= deadline:
+            return
 
 
 def assert_etcd_member(rm_node):
@@ -433,8 +522,43 @@ def assert_etcd_member(rm_node):
                                   "etcd cluster before remove it from lain" % rm_node)
 
 
-def copy_public_key(ip):
+def copy_public_key(ip, port=22):
     cmd = ['sudo', 'ssh-copy-id', '-i', '/root/.ssh/lain.pub']
+    if int(port) != 22:
+        cmd += ['-p', str(port)]
     cmd += ['root@%s' % ip]
     info('run cmd: %s', ' '.join(cmd))
     check_output(cmd)
+
+
+def can_ssh(ip, port):
+    """whether the lain key logs in the node without a password"""
+    p = Popen(ssh_cmd(ip, port, 'true'), stdout=PIPE, stderr=PIPE)
+    p.communicate()
+    return p.returncode == 0
+
+
+def preflight_node(ip, port, docker_device):
+    """the problems that stop the node from being added, empty if none"""
+    command = "df -Pk / | tail -n 1"
+    if docker_device:
+        command += " && (test -b %s && echo device-ok || echo device-missing)" % (
+            pipes.quote(docker_device))
+    p = Popen(ssh_cmd(ip, port, command), stdout=PIPE, stderr=PIPE)
+    output, err = p.communicate()
+    if p.returncode != 0:
+        # the last line of ssh is the reason, the ones before are warnings
+        return ["ssh failed: %s" % (err.strip().splitlines() or ["exit %d" % p.returncode])[-1]]
+
+    problems = []
+    lines = output.splitlines()
+    try:
+        free_mb = int(lines[0].split()[3]) / 1024
+    except (IndexError, ValueError):
+        problems.append("unknown free disk of /")
+    else:
+        if free_mb < ADD_NODE_MIN_FREE_MB:
+            problems.append("only %dMB free on /, %dMB needed" % (free_mb, ADD_NODE_MIN_FREE_MB))
+    if docker_device and lines[-1:] != ['device-ok']:
+        problems.append("docker device %s does not exist" % docker_device)
+    return problems
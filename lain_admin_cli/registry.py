@@ -1,24 +1,36 @@
 # -*- coding: utf-8 -*-
 import operator
+from collections import OrderedDict
 import requests
 import httplib
+import base64
 import json
+import re
 import time
+import threading
+from urlparse import urlparse
 
 from datetime import datetime
 from os import environ
 from argh.decorators import arg
 from argh import CommandError
-from subprocess import check_output
 from lain_admin_cli.helpers import (
-    TwoLevelCommandBase, info, warn, error
+    TwoLevelCommandBase, info, warn, error, get_etcd_client, get_cluster_config,
+    human_size
 )
 from lain_admin_cli.utils.utils import regex_match
+from lain_admin_cli.utils.concurrency import (
+    parallel_map, parallel_imap, pooled_session, RateLimiter
+)
+from lain_admin_cli.utils.cache import JsonCache
 
 REPOS_URL_TEMPLATE = "http://%s/v2/_catalog"
 TAGS_URL_TEMPLATE = "http://%s/v2/%s/tags/list"
 MANIFEST_URL_TEMPLATE = "http://%s/v2/%s/manifests/%s"
 HTTP_REGISTRY_HOST = 'http://%s'
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+
+POD_GROUPS_KEY = "/lain/deployd/pod_groups"
 
 REPOSITORIES = "repositories"
 PREPARE = "prepare"
@@ -37,6 +49,43 @@ TIME_OUT = float(environ.get('REGISTRY_TIMEOUT', 5))
 
 DEFAULT_REMAIN_TIME = int(environ.get('REMAIN_TIME', 30 * 24 * 3600))
 
+DEFAULT_CONCURRENCY = int(environ.get('REGISTRY_CONCURRENCY', 8))
+DEFAULT_MAX_REQUESTS = int(environ.get('REGISTRY_MAX_REQUESTS', 32))
+
+DEFAULT_PAGE_SIZE = int(environ.get('REGISTRY_PAGE_SIZE', 100))
+
+DIGEST_CACHE_TTL = int(environ.get('REGISTRY_DIGEST_CACHE_TTL', 7 * 24 * 3600))
+DIGEST_CACHE_SIZE = int(environ.get('REGISTRY_DIGEST_CACHE_SIZE', 200000))
+# manifests are addressed by digest and never change, the ttl only
+# bounds how long deleted ones stay in the cache
+MANIFEST_CACHE_TTL = 30 * 24 * 3600
+MANIFEST_CACHE_SIZE = int(environ.get('REGISTRY_MANIFEST_CACHE_SIZE', 100000))
+
+# tokens without expires_in or jwt exp live 60 seconds, as in the
+# docker registry token spec; refresh them a little before they expire
+DEFAULT_TOKEN_LIFETIME = 60
+TOKEN_REFRESH_MARGIN = 10
+CHALLENGE_CACHE_TTL = 24 * 3600
+
+# caps the in-flight http requests of the whole process, see _limit_requests
+_inflight = None
+# tag -> digest cache, opened by the registry commands, see _open_caches
+_digest_cache = None
+# digest -> manifest blobs cache, used by registry du
+_manifest_cache = None
+# (repo, tag) and (repo, digest) of images deployd runs, see _load_in_use_images
+_in_use_images = frozenset()
+# persisted CHALLENGE_CACHE, see _open_caches. tokens are secrets and
+# only ever kept in memory
+_challenge_store = None
+# guards _token_locks, every token url has its own lock so that the tokens
+# of different scopes are fetched concurrently
+_token_lock = threading.Lock()
+_token_locks = {}
+# (host, repo, action) -> the Www-Authenticate challenge registry answered,
+# used to attach tokens before the registry asks for them
+CHALLENGE_CACHE = {}
+
 
 class Repo:
 
@@ -45,12 +94,35 @@ class Repo:
         self.tags = tags
 
 
+class CleanResult:
+
+    def __init__(self, repo_name):
+        self.repo_name = repo_name
+        self.deleted = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+
+class RepoUsage:
+
+    def __init__(self, repo_name):
+        self.repo_name = repo_name
+        self.tags = []
+        self.blobs = {}
+        self.unique = 0
+
+    @property
+    def size(self):
+        return sum(self.blobs.values())
+
+
 class Image:
 
-    def __init__(self, repo_name, tag, digest):
+    def __init__(self, repo_name, tag, digest, reason=""):
         self.repo_name = repo_name
         self.tag = tag
         self.digest = digest
+        self.reason = reason
 
     def __str__(self):
         return "{%s, %s, %s}" % (self.repo_name, self.tag, self.digest)
@@ -62,31 +134,44 @@ def _time_during(ts1, ts2, t):
     return total_seconds <= t
 
 
+def _session(concurrency=DEFAULT_CONCURRENCY):
+    return pooled_session(concurrency)
+
+
+def _limit_requests(max_requests):
+    global _inflight
+    _inflight = threading.BoundedSemaphore(max_requests)
+
+
+def _send(session, method, url, headers):
+    if _inflight is None:
+        return session.request(method, url, headers=headers, timeout=TIME_OUT)
+    with _inflight:
+        return session.request(method, url, headers=headers, timeout=TIME_OUT)
+
+
 def _domain():
     try:
-        return check_output(['etcdctl', 'get', '/lain/config/domain']).strip('\n')
+        return get_cluster_config().domain
     except Exception as e:
         error('Get lain domain failed! error:%s', str(e))
 
 
-def _request_auth(session, method, url, auth_head, **kwargs):
-    token = _token(auth_head)
+def _request_auth(session, method, url, auth_head, expired=False, **kwargs):
+    token = _token(session, auth_head, expired)
     if token is None:
         return
     headers = {'Authorization': 'Bearer %s' % token}
     headers.update(kwargs)
     try:
-        resp = session.request(method, url, headers=headers, timeout=TIME_OUT)
-        if resp.status_code >= 300 or resp.status_code < 200:
-            error('Requests url(%s) failed! error: registry server faltal error', url)
-            return
+        resp = _send(session, method, url, headers)
         if resp.status_code == 401:
-            token = _token(auth_head, expired=True)
+            # the token may be revoked before it expires, fetch a new one
+            token = _token(session, auth_head, expired=True)
             if token is None:
                 return resp
             headers['Authorization'] = 'Bearer %s' % token
-            resp = session.request(
-                method, url, headers=headers, timeout=TIME_OUT)
+            resp = _send(session, method, url, headers)
         return resp
     except Exception as e:
         error('Requests url(%s) failed! error:%s', url, str(e))
@@ -94,11 +179,20 @@ def _request_auth(session, method, url, auth_head, **kwargs):
 
 def _request(session, method, url, **kwargs):
     try:
-        resp = session.request(method, url, headers=kwargs, timeout=TIME_OUT)
+        headers = dict(kwargs)
+        scope_key = _scope_key(method, url)
+        auth_head = _challenge(scope_key)
+        if auth_head is not None:
+            token = _token(session, auth_head)
+            if token is not None:
+                headers['Authorization'] = 'Bearer %s' % token
+        resp = _send(session, method, url, headers)
         if resp.status_code == 401:
             auth_head = resp.headers['Www-Authenticate']
+            _remember_challenge(scope_key, auth_head)
             resp_auth = _request_auth(
-                session, method, url, auth_head, **kwargs)
+                session, method, url, auth_head,
+                expired='Authorization' in headers, **kwargs)
             if resp_auth is not None:
                 resp = resp_auth
         if resp is None:
@@ -111,80 +205,189 @@ def _request(session, method, url, **kwargs):
         error('Requests url(%s) failed! error:%s', url, str(e))
 
 
-def _token(auth_head, expired=False):
+def _scope_key(method, url):
+    parsed = urlparse(url)
+    repo = parsed.path[len('/v2/'):]
+    for sep in ('/tags/', '/manifests/', '/blobs/'):
+        if sep in repo:
+            repo = repo.split(sep)[0]
+            break
+    action = 'pull' if method in ('GET', 'HEAD') else method.lower()
+    return "%s %s %s" % (parsed.netloc, repo, action)
+
+
+def _challenge(scope_key):
+    auth_head = CHALLENGE_CACHE.get(scope_key)
+    if auth_head is None and _challenge_store is not None:
+        auth_head = _challenge_store.get(scope_key)
+        if auth_head is not None:
+            CHALLENGE_CACHE[scope_key] = auth_head
+    return auth_head
+
+
+def _remember_challenge(scope_key, auth_head):
+    CHALLENGE_CACHE[scope_key] = auth_head
+    if _challenge_store is not None:
+        _challenge_store.set(scope_key, auth_head)
+
+
+def _cached_token(token_url):
+    entry = TOKEN_CACHE.get(token_url)
+    if entry is None or entry['expires_at'] - TOKEN_REFRESH_MARGIN <= time.time():
+        return None
+    return entry['token']
+
+
+def _url_lock(token_url):
+    with _token_lock:
+        return _token_locks.setdefault(token_url, threading.Lock())
+
+
+def _token(session, auth_head, expired=False):
     token_url = _token_url(auth_head)
-    token = TOKEN_CACHE.get(token_url)
-    if not expired and token is not None:
+    if not expired:
+        token = _cached_token(token_url)
+        if token is not None:
+            return token
+    with _url_lock(token_url):
+        # another worker may have refreshed the token while we waited
+        token = _cached_token(token_url)
+        if token is not None and not expired:
+            return token
+        try:
+            resp = _send(session, 'GET', token_url, {})
+            payload = resp.json()
+            token = payload.get('token') or payload.get('access_token')
+        except Exception as e:
+            error('Fetch auth token failed ! error:%s', str(e))
+            return token
+        if token is not None:
+            entry = {'token': token,
+                     'expires_at': _token_expires_at(payload, token)}
+            TOKEN_CACHE[token_url] = entry
         return token
+
+
+def _token_expires_at(payload, token):
+    if payload.get('expires_in'):
+        return time.time() + int(payload['expires_in'])
     try:
-        resp = requests.get(token_url)
-        token = resp.json().get('token')
-    except Exception as e:
-        error('Fetch auth token failed ! error:%s', str(e))
-        return token
-    if token is not None:
-        TOKEN_CACHE[token_url] = token
-    return token
+        claims = token.split('.')[1]
+        claims += '=' * (-len(claims) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(str(claims))).get('exp')
+        if exp:
+            return float(exp)
+    except Exception:
+        pass
+    return time.time() + DEFAULT_TOKEN_LIFETIME
 
 
 def _token_url(auth_head):
-    auth_infos = auth_head.split(',')
-    token_params = {}
-    for info in auth_infos:
-        k, v = info.split('=')
-        token_params[k] = v.strip('"')
+    # scope may contain commas, e.g. repository:app:pull,delete
+    token_params = dict((k.strip(), v) for k, v in
+                        re.findall(r'([^=,]+)="([^"]*)"', auth_head))
     token_url = "%s?service=%s&scope=%s" % (token_params[REALM], token_params[
                                             SERVICE], token_params[SCOPE])
     return token_url
 
 
-def _registry_repos(session):
+def _pages(session, url, key, page_size):
+    """
+    yield a paginated registry list api page by page, following the
+    `Link: <...>; rel="next"` header until the last page
+    """
+    url = "%s?n=%d" % (url, page_size)
+    while True:
+        resp = _request(session, 'GET', url)
+        if resp is None:
+            return
+        yield resp.json().get(key) or []
+        link = resp.headers.get('Link', None)
+        if link is None:
+            return
+        uri = regex_match(r'<(.*)>; rel="next"', link)[0]
+        url = (HTTP_REGISTRY_HOST % registry_host) + uri
+
+
+def _registry_repos(session, page_size=DEFAULT_PAGE_SIZE):
     url = REPOS_URL_TEMPLATE % registry_host
-    repos = []
     try:
-        while(True):
-            resp = _request(session, 'GET', url)
-            if resp is None:
-                return[]
-            repos.extend(resp.json().get(REPOSITORIES))
-            link = resp.headers.get('Link', None)
-            if link is None:
-                break
-            uri = regex_match(r'<(.*)>; rel="next"', link)[0]
-            url = (HTTP_REGISTRY_HOST % registry_host) + uri
-        return repos
+        for repos in _pages(session, url, REPOSITORIES, page_size):
+            for repo in repos:
+                yield repo
     except Exception as e:
         error('Fetch all repositories failed! error:%s', str(e))
-    return repos
 
 
-def _digest_from_tag(session, repo, tag):
+def _open_caches(enabled=True):
+    global _digest_cache, _challenge_store, _manifest_cache
+    _digest_cache = JsonCache('registry-digests', DIGEST_CACHE_TTL,
+                              DIGEST_CACHE_SIZE, enabled)
+    _challenge_store = JsonCache('registry-challenges', CHALLENGE_CACHE_TTL, enabled=enabled)
+    _manifest_cache = JsonCache('registry-manifests', MANIFEST_CACHE_TTL,
+                                MANIFEST_CACHE_SIZE, enabled)
+
+
+def _save_caches():
+    for cache in (_digest_cache, _challenge_store, _manifest_cache):
+        if cache is not None:
+            cache.save()
+
+
+def _digest_cache_key(repo, tag):
+    return "%s/%s:%s" % (registry_host, repo, tag)
+
+
+def _cacheable_tag(tag):
+    # release/meta/prepare tags carry a timestamp and are never re-pushed
+    return tag.split('-')[0] in (RELEASE, META, PREPARE)
+
+
+def _forget_digests(images):
+    if _digest_cache is None:
+        return
+    for image in images:
+        _digest_cache.delete(_digest_cache_key(image.repo_name, image.tag))
+
+
+def _digest_from_tag(session, repo, tag, use_cache=True):
+    cache = _digest_cache if use_cache and _cacheable_tag(tag) else None
+    if cache is not None:
+        digest = cache.get(_digest_cache_key(repo, tag))
+        if digest:
+            return digest
     manifest_url = MANIFEST_URL_TEMPLATE % (registry_host, repo, tag)
-    resp = _request(session, 'HEAD', manifest_url,
-                    Accept="application/vnd.docker.distribution.manifest.v2+json")
+    resp = _request(session, 'HEAD', manifest_url, Accept=MANIFEST_V2)
     if resp is None:
         return ""
-    return resp.headers.get('Docker-Content-Digest')
-
-
-def _repo_images(session, repo):
+    digest = resp.headers.get('Docker-Content-Digest')
+    if cache is not None and digest:
+        cache.set(_digest_cache_key(repo, tag), digest)
+    return digest
+
+
+def _iter_repo_images(session, repo, concurrency=DEFAULT_CONCURRENCY,
+                      page_size=DEFAULT_PAGE_SIZE):
+    """
+    yield the images of repo one tags page at a time, digests of tags seen
+    before come from the digest cache and only the unknown tags are
+    resolved by registry
+    """
     tags_url = TAGS_URL_TEMPLATE % (registry_host, repo)
-    resp = _request(session, 'GET', tags_url)
-    if resp is None:
-        return []
     try:
-        images = []
-        tags = resp.json().get('tags')
-        if not tags:
-            return images
-        for tag in tags:
-            digest = _digest_from_tag(session, repo, tag)
-            if digest != "":
-                images.append(Image(repo, tag, digest))
-        return images
+        for tags in _pages(session, tags_url, 'tags', page_size):
+            digests = parallel_map(lambda tag: _digest_from_tag(session, repo, tag),
+                                   tags, concurrency)
+            for tag, digest in zip(tags, digests):
+                if digest != "":
+                    yield Image(repo, tag, digest)
     except Exception as e:
         error('Fetch repo(%s)\'s images failed! error:%s', repo, str(e))
-    return []
+
+
+def _repo_images(session, repo, concurrency=DEFAULT_CONCURRENCY,
+                 page_size=DEFAULT_PAGE_SIZE):
+    return list(_iter_repo_images(session, repo, concurrency, page_size))
 
 
 def _image_timestamp(image):
@@ -210,10 +413,43 @@ def _delete_image(session, image):
         registry_host, image.repo_name, image.digest)
     resp = _request(session, 'DELETE', manifest_url)
     info("Delete image(%s) result:%s ", image, resp)
-
-
-def ordered_images(session, repo):
-    images = _repo_images(session, repo)
+    if resp is not None:
+        _forget_digests([image])
+    return resp is not None
+
+
+def _delete_images(session, images, concurrency=DEFAULT_CONCURRENCY,
+                   limiter=None, on_deleted=None):
+    """
+    delete images in batch, a manifest is deleted only once no matter how
+    many tags point to it. return a list of (digest, tags, success)
+    """
+    digest_images = OrderedDict()
+    for image in images:
+        digest_images.setdefault((image.repo_name, image.digest), []).append(image)
+
+    def delete(same_digest_images):
+        image = same_digest_images[0]
+        tags = [i.tag for i in same_digest_images]
+        manifest_url = MANIFEST_URL_TEMPLATE % (
+            registry_host, image.repo_name, image.digest)
+        if limiter is not None:
+            limiter.acquire()
+        resp = _request(session, 'DELETE', manifest_url)
+        if resp is not None:
+            _forget_digests(same_digest_images)
+            if on_deleted is not None:
+                on_deleted(image)
+            info("Deleted %s@%s, removed tags: %s",
+                 image.repo_name, image.digest, ', '.join(tags))
+        return image.digest, tags, resp is not None
+
+    return parallel_map(delete, digest_images.values(), concurrency)
+
+
+def ordered_images(session, repo, concurrency=DEFAULT_CONCURRENCY,
+                   page_size=DEFAULT_PAGE_SIZE):
+    images = _repo_images(session, repo, concurrency, page_size)
     times_images = {}
     for image in images:
         timestamp = _image_timestamp(image)
@@ -222,7 +458,8 @@ def ordered_images(session, repo):
 
 
 def delete_image_tag(session, repo, tag):
-    digest = _digest_from_tag(session, repo, tag)
+    # always ask registry, never delete a manifest by a stale cached digest
+    digest = _digest_from_tag(session, repo, tag, use_cache=False)
     if digest == '':
         error('no such repo or repo has no such tag')
         return
@@ -230,67 +467,329 @@ def delete_image_tag(session, repo, tag):
     _delete_image(session, image)
 
 
-def delete_repo(session, repo):
+def delete_repo(session, repo, concurrency=DEFAULT_CONCURRENCY,
+                page_size=DEFAULT_PAGE_SIZE):
     info('start delete repo:%s!', repo)
-    images = _repo_images(session, repo)
-    for image in images:
-        _delete_image(session, image)
+    images = _repo_images(session, repo, concurrency, page_size)
+    _delete_images(session, images, concurrency)
     info('delete repo:%s over!', repo)
 
 
-def clear_expired_repo(session, repo, repo_remain, time_remain):
+def clear_expired_repo(session, repo, repo_remain, time_remain,
+                       concurrency=DEFAULT_CONCURRENCY, page_size=DEFAULT_PAGE_SIZE):
     info('----------------------------')
     info('Start clean registry repo %s', repo)
-    classified_images = {
-        META: {}, RELEASE: {}, PREPARE: {}
-    }
+    result = CleanResult(repo)
     now = time.time()
     try:
-        images = _repo_images(session, repo)
+        images = _repo_images(session, repo, concurrency, page_size)
         if len(images) <= repo_remain:
-            return
-        for image in images:
-            try:
-                image_type = image.tag.split('-')[0]
-            except Exception as e:
-                warn('Strange image :%s', image.tag)
-                continue
-            timestamp = _image_timestamp(image)
-            if timestamp == 0:
-                if image.tag.find('-config-') > 0:
-                    info("specific config image: %s", image)
-                    _delete_image(session, image)
-                continue
-            if(_time_during(now, timestamp, time_remain)):
-                continue
-
-            target_type_images = classified_images.get(image_type, None)
-            if target_type_images is None:
-                warn('Strange image type:%s', image.tag)
-                continue
-
-            target_type_images[timestamp] = image
-
-        for _, image_map in classified_images.items():
-            sorted_images = sort_map_values(image_map)
-            for image in sorted_images[repo_remain:]:
-                _delete_image(session, image)
+            return result
+        expired = _expired_images(images, repo_remain, time_remain, now)
+        for _, tags, success in _delete_images(session, expired, concurrency):
+            if success:
+                result.deleted += len(tags)
+            else:
+                result.failed += len(tags)
     except Exception as e:
+        result.failed += 1
         error('Clean registry failed! error:%s', str(e))
     finally:
+        result.elapsed = time.time() - now
         info('Clean registry repo %s over', repo)
-
-
-def clear_all_expired_repos(session, repo_remain, time_remain):
+    return result
+
+
+def _image_ref(name):
+    """
+    split an image name like registry.lain.local/app:release-1-abc or
+    app@sha256:... into (repo, tag or digest)
+    """
+    parts = name.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        name = parts[1]
+    if '@' in name:
+        return tuple(name.split('@', 1))
+    repo, sep, tag = name.rpartition(':')
+    if not sep or '/' in tag:
+        return name, 'latest'
+    return repo, tag
+
+
+def _pod_group_images(data):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == 'Image' and isinstance(v, basestring):
+                yield v
+            else:
+                for image in _pod_group_images(v):
+                    yield image
+    elif isinstance(data, list):
+        for v in data:
+            for image in _pod_group_images(v):
+                yield image
+
+
+def in_use_images():
+    """
+    return the set of (repo, tag or digest) of every image in deployd's pod
+    groups, read from etcd with one recursive request
+    """
+    images = set()
+    result = get_etcd_client().read(POD_GROUPS_KEY, recursive=True)
+    for node in result.leaves:
+        if node.dir or not node.value:
+            continue
+        try:
+            pod_group = json.loads(node.value)
+        except ValueError:
+            continue
+        for name in _pod_group_images(pod_group):
+            images.add(_image_ref(name))
+    return images
+
+
+def _load_in_use_images():
+    global _in_use_images
+    _in_use_images = frozenset(in_use_images())
+    info('%d images are used by deployd pod groups and will be kept',
+         len(_in_use_images))
+
+
+def _in_use(image):
+    return ((image.repo_name, image.tag) in _in_use_images or
+            (image.repo_name, image.digest) in _in_use_images)
+
+
+def _expired_images(images, repo_remain, time_remain, now):
+    classified_images = {
+        META: {}, RELEASE: {}, PREPARE: {}
+    }
+    expired = []
+    for image in images:
+        try:
+            image_type = image.tag.split('-')[0]
+        except Exception as e:
+            warn('Strange image :%s', image.tag)
+            continue
+        timestamp = _image_timestamp(image)
+        if timestamp == 0:
+            if image.tag.find('-config-') > 0:
+                info("specific config image: %s", image)
+                image.reason = "config image"
+                expired.append(image)
+            continue
+        if(_time_during(now, timestamp, time_remain)):
+            continue
+
+        target_type_images = classified_images.get(image_type, None)
+        if target_type_images is None:
+            warn('Strange image type:%s', image.tag)
+            continue
+
+        target_type_images[timestamp] = image
+
+    for image_type, image_map in classified_images.items():
+        sorted_images = sort_map_values(image_map)
+        for image in sorted_images[repo_remain:]:
+            image.reason = "older than %ds and not in the latest %d %s images" % (
+                time_remain, repo_remain, image_type)
+            expired.append(image)
+
+    for image in expired:
+        if _in_use(image):
+            warn('Keep image %s, it is used by deployd pod groups', image)
+    expired = [image for image in expired if not _in_use(image)]
+
+    # deleting a manifest removes every tag pointing to it, so a digest
+    # shared with a remained tag must not be deleted
+    expired_ids = set(id(image) for image in expired)
+    remained_digests = set(image.digest for image in images
+                           if id(image) not in expired_ids)
+    for image in expired:
+        if image.digest in remained_digests:
+            warn('Keep image %s, its digest is shared with remained tags', image)
+    return [image for image in expired if image.digest not in remained_digests]
+
+
+def clear_all_expired_repos(session, repo_remain, time_remain,
+                            concurrency=DEFAULT_CONCURRENCY, parallel=1,
+                            page_size=DEFAULT_PAGE_SIZE):
     info('Start clean registry')
     info('============================')
-    repos = _registry_repos(session)
-    if not isinstance(repos, list) or len(repos) == 0:
-        return
-    for repo in repos:
-        clear_expired_repo(session, repo, repo_remain, time_remain)
+    start = time.time()
+    # repos are cleaned while the later catalog pages are still loading
+    repos = _registry_repos(session, page_size)
+    results = list(parallel_imap(
+        lambda repo: clear_expired_repo(session, repo, repo_remain,
+                                        time_remain, concurrency, page_size),
+        repos, parallel))
     info('============================')
     info('Clean registry over')
+    _print_clean_summary(results, time.time() - start)
+
+
+def plan_expired_repos(session, repos, repo_remain, time_remain,
+                       concurrency=DEFAULT_CONCURRENCY, parallel=1,
+                       page_size=DEFAULT_PAGE_SIZE):
+    """
+    yield the images clean would delete from repos, without deleting them
+    """
+    now = time.time()
+
+    def plan(repo):
+        info('Planning registry repo %s', repo)
+        images = _repo_images(session, repo, concurrency, page_size)
+        if len(images) <= repo_remain:
+            return []
+        return _expired_images(images, repo_remain, time_remain, now)
+
+    for images in parallel_imap(plan, repos, parallel):
+        for image in images:
+            yield image
+
+
+def write_plan(plan_file, images):
+    plan = {
+        'registry': registry_host,
+        'created': int(time.time()),
+        'images': [{'repo': image.repo_name, 'tag': image.tag,
+                    'digest': image.digest,
+                    'timestamp': _image_timestamp(image),
+                    'reason': image.reason} for image in images],
+    }
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=2)
+    info('Plan of %d images written to %s', len(plan['images']), plan_file)
+
+
+def apply_plan(session, plan_file, concurrency=DEFAULT_CONCURRENCY, rate=0):
+    """
+    delete the images of a plan written by `registry clean --plan`,
+    deleted manifests are recorded in <plan_file>.done so an interrupted
+    apply resumes where it stopped
+    """
+    global registry_host
+    with open(plan_file) as f:
+        plan = json.load(f)
+    registry_host = plan['registry']
+
+    done_file = plan_file + '.done'
+    try:
+        with open(done_file) as f:
+            done = set(line.strip() for line in f)
+    except IOError:
+        done = set()
+    done_lock = threading.Lock()
+
+    def checkpoint(image):
+        with done_lock:
+            with open(done_file, 'a') as f:
+                f.write('%s@%s\n' % (image.repo_name, image.digest))
+
+    images = [Image(i['repo'], i['tag'], i['digest'], i['reason'])
+              for i in plan['images']
+              if '%s@%s' % (i['repo'], i['digest']) not in done]
+    # deployd may have started to use a planned image since the plan was written
+    for image in images:
+        if _in_use(image):
+            warn('Keep image %s, it is used by deployd pod groups', image)
+    images = [image for image in images if not _in_use(image)]
+    info('Applying plan %s: %d images to delete, %d already done',
+         plan_file, len(images), len(plan['images']) - len(images))
+    start = time.time()
+    results = _delete_images(session, images, concurrency,
+                             RateLimiter(rate), checkpoint)
+    failed = [digest for digest, _, success in results if not success]
+    info('%d manifests deleted, %d failures, %.1fs in total',
+         len(results) - len(failed), len(failed), time.time() - start)
+    if failed:
+        warn('Run `registry apply %s` again to retry the failures', plan_file)
+
+
+def _print_clean_summary(results, elapsed):
+    if not results:
+        return
+    width = 2 + max(4, *(len(r.repo_name) for r in results))
+    row_fmt = "%-{width}s%-10s%-10s%s".format(width=width)
+    info('%s', row_fmt % ("REPO", "DELETED", "FAILED", "TIME(s)"))
+    for r in results:
+        info('%s', row_fmt % (r.repo_name, r.deleted, r.failed, "%.1f" % r.elapsed))
+    info('%d repos, %d images deleted, %d failures, %.1fs in total',
+         len(results), sum(r.deleted for r in results),
+         sum(r.failed for r in results), elapsed)
+
+
+def _manifest_blobs(session, repo, digest):
+    """
+    return [[blob digest, size], ...] of the v2 manifest, config blob included
+    """
+    key = "%s@%s" % (registry_host, digest)
+    if _manifest_cache is not None:
+        blobs = _manifest_cache.get(key)
+        if blobs is not None:
+            return blobs
+    manifest_url = MANIFEST_URL_TEMPLATE % (registry_host, repo, digest)
+    resp = _request(session, 'GET', manifest_url, Accept=MANIFEST_V2)
+    if resp is None:
+        return None
+    try:
+        manifest = resp.json()
+        blobs = [[blob['digest'], blob['size']]
+                 for blob in [manifest['config']] + manifest['layers']]
+    except Exception as e:
+        warn('Unsupported manifest %s@%s, error:%s', repo, digest, str(e))
+        return None
+    if _manifest_cache is not None:
+        _manifest_cache.set(key, blobs)
+    return blobs
+
+
+def registry_usage(session, repos, concurrency=DEFAULT_CONCURRENCY,
+                   page_size=DEFAULT_PAGE_SIZE):
+    """
+    return the RepoUsage of every repo and the total size of registry,
+    a blob shared by several tags or repos is only counted once
+    """
+    usages = []
+    blob_repos = {}
+    blob_sizes = {}
+    for repo in repos:
+        usage = RepoUsage(repo)
+        images = _repo_images(session, repo, concurrency, page_size)
+        digests = list(OrderedDict.fromkeys(image.digest for image in images))
+        manifests = dict(zip(digests, parallel_map(
+            lambda digest: _manifest_blobs(session, repo, digest),
+            digests, concurrency)))
+        for image in images:
+            blobs = manifests.get(image.digest)
+            if blobs is None:
+                continue
+            usage.tags.append((image.tag, sum(size for _, size in blobs)))
+            usage.blobs.update(blobs)
+        for blob, size in usage.blobs.items():
+            blob_repos[blob] = blob_repos.get(blob, 0) + 1
+            blob_sizes[blob] = size
+        usages.append(usage)
+    for usage in usages:
+        usage.unique = sum(size for blob, size in usage.blobs.items()
+                           if blob_repos[blob] == 1)
+    return usages, sum(blob_sizes.values())
+
+
+def _print_usage(usages, total, with_tags):
+    if not usages:
+        return
+    width = 2 + max(4, *(len(u.repo_name) for u in usages))
+    row_fmt = "%-{width}s%-8s%-12s%s".format(width=width)
+    info('%s', row_fmt % ("REPO", "TAGS", "SIZE", "UNIQUE"))
+    for usage in sorted(usages, key=lambda u: u.size, reverse=True):
+        info('%s', row_fmt % (usage.repo_name, len(usage.tags),
+                              human_size(usage.size), human_size(usage.unique)))
+        if with_tags:
+            for tag, size in usage.tags:
+                info("  %-40s%s", tag, human_size(size))
+    info('%d repos, %s in total', len(usages), human_size(total))
 
 
 def sort_map_values(origin_map):
@@ -302,7 +801,7 @@ class Registry(TwoLevelCommandBase):
 
     @classmethod
     def subcommands(self):
-        return [self.list, self.delete, self.clean]
+        return [self.list, self.delete, self.clean, self.apply, self.du]
 
     @classmethod
     def namespace(self):
@@ -315,51 +814,167 @@ class Registry(TwoLevelCommandBase):
     @classmethod
     @arg('-t', '--target', required=False, help="target repository in registry")
     @arg('-s', '--sort', required=False, help="return results in order")
-    def list(self, target="all", sort=False):
-        session = requests.Session()
+    @arg('-c', '--concurrency', required=False, help="max concurrent requests when resolving image digests")
+    @arg('--no-cache', required=False, help="do not use the local digest and auth challenge caches")
+    @arg('--page-size', required=False, help="number of repositories or tags fetched per request")
+    def list(self, target="all", sort=False, concurrency=DEFAULT_CONCURRENCY,
+             no_cache=False, page_size=DEFAULT_PAGE_SIZE):
+        self._check_concurrency(concurrency)
+        self._check_page_size(page_size)
+        session = _session(concurrency)
         self._update_domain()
-        if target == "all":
-            repos = _registry_repos(session)
-            for repo in repos:
-                info(repo)
-        else:
-            if sort:
-                images = ordered_images(session, target)
+        _open_caches(not no_cache)
+        try:
+            if target == "all":
+                repos = _registry_repos(session, page_size)
+                for repo in repos:
+                    info(repo)
             else:
-                images = _repo_images(session, target)
-            for image in images:
-                info('%s', image)
+                if sort:
+                    images = ordered_images(session, target, concurrency,
+                                            page_size)
+                else:
+                    images = _iter_repo_images(session, target, concurrency,
+                                               page_size)
+                for image in images:
+                    info('%s', image)
+        finally:
+            _save_caches()
 
     @classmethod
     @arg('-r', '--repo', required=True, help="repository in registry")
     @arg('-t', '--tag', required=False, help="image tag in registry")
-    def delete(self, repo='', tag=''):
-        session = requests.Session()
+    @arg('-c', '--concurrency', required=False, help="max concurrent requests when resolving image digests")
+    @arg('--no-cache', required=False, help="do not use the local digest and auth challenge caches")
+    @arg('--page-size', required=False, help="number of tags fetched per request")
+    def delete(self, repo='', tag='', concurrency=DEFAULT_CONCURRENCY,
+               no_cache=False, page_size=DEFAULT_PAGE_SIZE):
+        self._check_concurrency(concurrency)
+        self._check_page_size(page_size)
+        session = _session(concurrency)
         self._update_domain()
-        if tag != '':
-            delete_image_tag(session, repo, tag)
-        else:
-            delete_repo(session, repo)
+        _open_caches(not no_cache)
+        try:
+            if tag != '':
+                delete_image_tag(session, repo, tag)
+            else:
+                delete_repo(session, repo, concurrency, page_size)
+        finally:
+            _save_caches()
 
     @classmethod
     @arg('-t', '--target', required=False, help="clean target repository in registry")
     @arg('-n', '--num', required=False, help="repository's remained quantity of images in registry(must bigger than 0)")
     @arg('-d', '--time', required=False, help="repository's remained time(seconds) of images in registry(must bigger than 0)")
-    def clean(self, num=20, time=DEFAULT_REMAIN_TIME, target="all"):
-        session = requests.Session()
+    @arg('-c', '--concurrency', required=False, help="max concurrent requests when resolving image digests")
+    @arg('-P', '--parallel', required=False, help="number of repositories cleaned at the same time")
+    @arg('-m', '--max-requests', required=False, help="max in-flight http requests to registry in total")
+    @arg('--no-cache', required=False, help="do not use the local digest and auth challenge caches")
+    @arg('--page-size', required=False, help="number of repositories or tags fetched per request")
+    @arg('--plan', required=False, help="write the images to delete into this file instead of deleting them")
+    @arg('--ignore-in-use', required=False, help="also delete the images deployd pod groups still use")
+    def clean(self, num=20, time=DEFAULT_REMAIN_TIME, target="all",
+              concurrency=DEFAULT_CONCURRENCY, parallel=1,
+              max_requests=DEFAULT_MAX_REQUESTS, no_cache=False,
+              page_size=DEFAULT_PAGE_SIZE, plan='', ignore_in_use=False):
+        self._check_concurrency(concurrency)
+        if parallel < 1:
+            raise CommandError("parallel must bigger than 0")
+        if max_requests < 1:
+            raise CommandError("max-requests must bigger than 0")
+        _limit_requests(max_requests)
+        session = _session(min(concurrency * parallel, max_requests))
         self._update_domain()
         if num < 1:
             raise CommandError("num must bigger than 0")
         if time < 1:
             raise CommandError("time must bigger than 0")
-        if target == "all":
-            clear_all_expired_repos(session, num, time)
-        else:
-            clear_expired_repo(session, target, num, time)
+        self._check_page_size(page_size)
+        if not ignore_in_use:
+            try:
+                _load_in_use_images()
+            except Exception as e:
+                raise CommandError("Fetch images in use from etcd failed: %s, "
+                                   "use --ignore-in-use to clean anyway" % e)
+        _open_caches(not no_cache)
+        try:
+            if plan != '':
+                repos = _registry_repos(session, page_size) if target == "all" else [target]
+                write_plan(plan, plan_expired_repos(session, repos, num, time,
+                                                    concurrency, parallel, page_size))
+            elif target == "all":
+                clear_all_expired_repos(session, num, time, concurrency,
+                                        parallel, page_size)
+            else:
+                clear_expired_repo(session, target, num, time, concurrency,
+                                   page_size)
+        finally:
+            _save_caches()
+
+    @classmethod
+    @arg('plan', help="plan file written by `registry clean --plan`")
+    @arg('-c', '--concurrency', required=False, help="max concurrent delete requests")
+    @arg('-r', '--rate', required=False, type=float, help="max delete requests per second, 0 means unlimited")
+    @arg('--ignore-in-use', required=False, help="also delete the images deployd pod groups still use")
+    def apply(self, plan, concurrency=DEFAULT_CONCURRENCY, rate=0, ignore_in_use=False):
+        """
+        delete the images listed in a plan written by `registry clean --plan`
+        """
+        self._check_concurrency(concurrency)
+        session = _session(concurrency)
+        if not ignore_in_use:
+            try:
+                _load_in_use_images()
+            except Exception as e:
+                raise CommandError("Fetch images in use from etcd failed: %s, "
+                                   "use --ignore-in-use to apply anyway" % e)
+        _open_caches()
+        try:
+            apply_plan(session, plan, concurrency, rate)
+        finally:
+            _save_caches()
+
+    @classmethod
+    @arg('-t', '--target', required=False, help="target repository in registry")
+    @arg('--tags', required=False, help="show the size of every tag")
+    @arg('-c', '--concurrency', required=False, help="max concurrent requests when fetching manifests")
+    @arg('--no-cache', required=False, help="do not use the local digest, manifest and auth challenge caches")
+    @arg('--page-size', required=False, help="number of repositories or tags fetched per request")
+    def du(self, target="all", tags=False, concurrency=DEFAULT_CONCURRENCY,
+           no_cache=False, page_size=DEFAULT_PAGE_SIZE):
+        """
+        show the storage used by registry repositories, SIZE counts the
+        layers shared by tags once and UNIQUE counts the layers no other
+        repository uses
+        """
+        self._check_concurrency(concurrency)
+        self._check_page_size(page_size)
+        session = _session(concurrency)
+        self._update_domain()
+        _open_caches(not no_cache)
+        try:
+            if target == "all":
+                repos = _registry_repos(session, page_size)
+            else:
+                repos, tags = [target], True
+            usages, total = registry_usage(session, repos, concurrency, page_size)
+            _print_usage(usages, total, tags)
+        finally:
+            _save_caches()
+
+    @classmethod
+    def _check_concurrency(self, concurrency):
+        if concurrency < 1:
+            raise CommandError("concurrency must bigger than 0")
+
+    @classmethod
+    def _check_page_size(self, page_size):
+        if page_size < 1:
+            raise CommandError("page-size must bigger than 0")
 
     @classmethod
     def _update_domain(self):
         domain = _domain()
         if domain is not None:
             global registry_host
-            registry_host = REGISTRY_FORMAT % _domain()
+            registry_host = REGISTRY_FORMAT % domain
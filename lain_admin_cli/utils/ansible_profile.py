@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from ConfigParser import RawConfigParser, Error as ConfigError
+from os import environ
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'ansible_plugins')
+PROFILE_DIR = environ.get('LAINCTL_ANSIBLE_PROFILE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.lainctl', 'ansible-profile'))
+CALLBACK_NAME = 'lainctl_profile'
+SLOWEST_TASKS = 10
+
+# the execution profile lainctl runs ansible-playbook with, set
+# LAINCTL_ANSIBLE_TUNING=0 to run ansible with its own defaults
+TUNING = environ.get('LAINCTL_ANSIBLE_TUNING', '1') != '0'
+FACT_CACHE_DIR = environ.get('LAINCTL_ANSIBLE_FACT_CACHE_DIR',
+                             os.path.join(os.path.expanduser('~'), '.lainctl', 'ansible-facts'))
+FACT_CACHE_TTL = int(environ.get('LAINCTL_ANSIBLE_FACT_CACHE_TTL', 600))
+FORKS = int(environ.get('LAINCTL_ANSIBLE_FORKS', 20))
+# ssh connections are kept for the next playbook run of the same command
+CONTROL_PERSIST = int(environ.get('LAINCTL_ANSIBLE_CONTROL_PERSIST', 300))
+
+
+def _tuned_settings():
+    """(env var, ansible.cfg section, ansible.cfg key, value) of the profile"""
+    return [
+        ('ANSIBLE_PIPELINING', 'ssh_connection', 'pipelining', 'True'),
+        ('ANSIBLE_SSH_PIPELINING', 'ssh_connection', 'pipelining', 'True'),
+        ('ANSIBLE_SSH_ARGS', 'ssh_connection', 'ssh_args',
+         '-C -o ControlMaster=auto -o ControlPersist=%ds' % CONTROL_PERSIST),
+        ('ANSIBLE_GATHERING', 'defaults', 'gathering', 'smart'),
+        ('ANSIBLE_CACHE_PLUGIN', 'defaults', 'fact_caching', 'jsonfile'),
+        ('ANSIBLE_CACHE_PLUGIN_CONNECTION', 'defaults', 'fact_caching_connection',
+         FACT_CACHE_DIR),
+        ('ANSIBLE_CACHE_PLUGIN_TIMEOUT', 'defaults', 'fact_caching_timeout',
+         str(FACT_CACHE_TTL)),
+        ('ANSIBLE_FORKS', 'defaults', 'forks', str(FORKS)),
+    ]
+
+
+def _user_config():
+    """the ansible.cfg ansible-playbook is going to read, the way ansible finds it"""
+    config = RawConfigParser(allow_no_value=True)
+    for path in [environ.get('ANSIBLE_CONFIG'), os.path.join(os.getcwd(), 'ansible.cfg'),
+                 os.path.expanduser('~/.ansible.cfg'), '/etc/ansible/ansible.cfg']:
+        if path and os.path.isfile(path):
+            try:
+                config.read(path)
+            except ConfigError:
+                pass
+            break
+    return config
+
+
+def execution_env():
+    """
+    the environment variables of the lainctl ansible execution profile:
+    ssh pipelining and long lived multiplexed connections, facts cached
+    in json files, and more forks. settings the user has made in the
+    environment or ansible.cfg are never overridden
+    """
+    if not TUNING:
+        return {}
+    config = _user_config()
+    env = {}
+    for name, section, key, value in _tuned_settings():
+        if name in environ or (config.has_section(section) and
+                               config.has_option(section, key)):
+            continue
+        env[name] = value
+    return env
+
+
+def profile_env(label):
+    """
+    the environment variables that make ansible-playbook record its timing
+    with the lainctl_profile callback, and the json file it is written to
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    path = os.path.join(PROFILE_DIR, '%s-%s-%d.json' % (
+        time.strftime('%Y%m%d-%H%M%S'), label, os.getpid()))
+
+    def extend(name, value, sep):
+        return sep.join(filter(None, [environ.get(name), value]))
+    env = {
+        'ANSIBLE_CALLBACK_PLUGINS': extend('ANSIBLE_CALLBACK_PLUGINS', PLUGINS_DIR, ':'),
+        # ansible < 2.11 and >= 2.11 names of the same setting
+        'ANSIBLE_CALLBACK_WHITELIST': extend('ANSIBLE_CALLBACK_WHITELIST', CALLBACK_NAME, ','),
+        'ANSIBLE_CALLBACKS_ENABLED': extend('ANSIBLE_CALLBACKS_ENABLED', CALLBACK_NAME, ','),
+        'LAINCTL_ANSIBLE_PROFILE': path,
+    }
+    return env, path
+
+
+def summarize(profile):
+    """the slowest tasks and the total time of every host, as text lines"""
+    tasks = sorted(profile['tasks'], key=lambda t: t['duration'], reverse=True)
+    hosts = {}
+    for task in profile['tasks']:
+        for host, result in task['hosts'].items():
+            hosts[host] = hosts.get(host, 0) + result['duration']
+
+    lines = ["total %.1fs, %d tasks" % (profile['elapsed'], len(tasks)), "slowest tasks:"]
+    for task in tasks[:SLOWEST_TASKS]:
+        name = "%s : %s" % (task['role'], task['name']) if task['role'] else task['name']
+        slowest = max(task['hosts'].items(), key=lambda h: h[1]['duration']) \
+            if task['hosts'] else None
+        lines.append("  %8.1fs  %s%s" % (
+            task['duration'], name,
+            " (slowest host %s %.1fs)" % (slowest[0], slowest[1]['duration'])
+            if slowest else ""))
+    lines.append("per host:")
+    for host, total in sorted(hosts.items(), key=lambda h: h[1], reverse=True):
+        lines.append("  %8.1fs  %s" % (total, host))
+    return lines
+
+
+def write_report(path):
+    """
+    write the timing report beside the json profile at path, returns its
+    lines, None if ansible did not write the profile
+    """
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (IOError, ValueError):
+        return None
+    lines = summarize(profile)
+    with open(os.path.splitext(path)[0] + '.txt', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return lines
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import threading
+import time
+from os import environ
+
+CACHE_DIR = environ.get('LAINCTL_CACHE_DIR',
+                        os.path.join(os.path.expanduser('~'), '.lainctl', 'cache'))
+
+
+class JsonCache(object):
+    """
+    a small on-disk key-value cache kept in CACHE_DIR/<name>.json,
+    entries expire after ttl seconds, and the least recently used
+    entries are evicted when there are more than max_entries on save.
+    """
+
+    def __init__(self, name, ttl, max_entries=10000, enabled=True):
+        self.path = os.path.join(CACHE_DIR, '%s.json' % name)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.entries = self._load() if enabled else {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if now - entry['created'] > self.ttl:
+                del self.entries[key]
+                self.dirty = True
+                return None
+            # recency only matters to eviction, it is written back with
+            # the next change instead of making every hit rewrite the file
+            entry['used'] = now
+            return entry['value']
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {'value': value, 'created': now, 'used': now}
+            self.dirty = True
+
+    def delete(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        if not self.enabled or not self.dirty:
+            return
+        with self.lock:
+            if len(self.entries) > self.max_entries:
+                keys = sorted(self.entries, key=lambda k: self.entries[k]['used'],
+                              reverse=True)
+                for key in keys[self.max_entries:]:
+                    del self.entries[key]
+            data = json.dumps(self.entries)
+            self.dirty = False
+        cache_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # cache is only an optimization, never fail the command for it
+            pass
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+# on python 2 an untimed wait on a pool result ignores Ctrl-C until it is
+# ready, a timed one is interruptible
+WAIT_TIMEOUT = 10 * 365 * 24 * 3600
+
+
+def parallel_map(func, items, concurrency):
+    """
+    apply func to every item with at most `concurrency` worker threads,
+    the results are returned in the same order as items.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        results = pool.map_async(func, items).get(WAIT_TIMEOUT)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def pooled_session(concurrency):
+    """a requests session keeping enough connections for `concurrency` workers"""
+    session = requests.Session()
+    # keep one pooled connection per worker, otherwise urllib3 drops them
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(concurrency, 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parallel_imap(func, items, concurrency, window=None):
+    """
+    like parallel_map, but items are consumed lazily and every result is
+    yielded, in order, as soon as it is ready. at most `window` items
+    (2 * concurrency by default) are taken ahead of the yielded results,
+    so a long generator of items is never read up front
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+    window = window or 2 * concurrency
+    pool = ThreadPool(concurrency)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get(WAIT_TIMEOUT)
+        while pending:
+            yield pending.popleft().get(WAIT_TIMEOUT)
+    except:
+        # also on GeneratorExit, when the consumer stops early
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
+class RateLimiter(object):
+    """
+    a token bucket allowing `rate` acquisitions per second on average
+    and bursts of at most `burst`, a rate <= 0 means unlimited
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -1,46 +1,105 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
+import time
 import requests
-from lain_admin_cli.helpers import info, error, warn
+from lain_admin_cli.helpers import info, error, warn, ssh_cmd
+from lain_admin_cli.utils.concurrency import parallel_map
 from subprocess import check_call, call, Popen, PIPE
 
 
+class CheckResult(object):
+
+    def __init__(self, item, ok, latency, reason=""):
+        self.item = item
+        self.ok = ok
+        self.latency = latency
+        self.reason = reason
+
+    def to_dict(self):
+        return {'ok': self.ok, 'latency': round(self.latency, 3),
+                'reason': self.reason}
+
+
+def timed_check(item, func, *args):
+    """run a check function, returning a CheckResult with its latency"""
+    start = time.time()
+    try:
+        ok = bool(func(*args))
+        reason = "" if ok else "unhealthy response"
+    except Exception as e:
+        ok, reason = False, str(e) or e.__class__.__name__
+    return CheckResult(item, ok, time.time() - start, reason)
+
+
+def run_checks(checks, timeout):
+    """
+    run [(item, check function), ...] concurrently and return their
+    CheckResults in order, checks not done after timeout seconds fail
+    """
+    start = time.time()
+    results = {}
+
+    def run(item, func):
+        results[item] = timed_check(item, func)
+
+    threads = []
+    for item, func in checks:
+        thread = threading.Thread(target=run, args=(item, func))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(start + timeout - time.time(), 0))
+    return [results.get(item) or
+            CheckResult(item, False, time.time() - start, "timed out after %ss" % timeout)
+            for item, _ in checks]
+
+
 class ClusterHealth(object):
+    """
+    the checks run concurrently and all of them are answered within
+    timeout seconds, a check still running then is reported as timed out
+    """
 
     CHECK_LIST = ['etcd', 'swarm', 'deployd', 'console']
 
-    def run(self):
-        for item in self.CHECK_LIST:
-            if self.check(item):
-                info("%s is ok" % item)
-            else:
-                error("%s is not ok" % item)
+    def __init__(self, timeout=5):
+        self.timeout = timeout
 
-    def check(self, item):
-        try:
-            return getattr(self, "check_%s" % item)()
-        except:
-            return False
+    def run(self, as_json=False):
+        results = run_checks([(item, getattr(self, "check_%s" % item))
+                              for item in self.CHECK_LIST], self.timeout)
+        if as_json:
+            print(json.dumps(dict((r.item, r.to_dict()) for r in results), indent=4))
+        else:
+            for r in results:
+                if r.ok:
+                    info("%s is ok (%dms)" % (r.item, r.latency * 1000))
+                else:
+                    error("%s is not ok (%dms): %s" % (r.item, r.latency * 1000, r.reason))
+        return all(r.ok for r in results)
 
     def check_etcd(self):
         url = "http://etcd.lain:4001/health"
-        resp = requests.get(url, timeout=5)
+        resp = requests.get(url, timeout=self.timeout)
         data = resp.json()
-        return data.get('health')
+        return data.get('health') in (True, 'true')
 
     def check_console(self):
         url = "http://console.lain/"
-        resp = requests.get(url, timeout=5)
+        resp = requests.get(url, timeout=self.timeout)
         return resp.status_code == 200
 
     def check_deployd(self):
         url = "http://deployd.lain:9003/api/status"
-        resp = requests.get(url, timeout=5)
+        resp = requests.get(url, timeout=self.timeout)
         data = resp.json()
         return 'status' in data
 
     def check_swarm(self):
         url = "http://swarm.lain:2376/_ping"
-        resp = requests.get(url, timeout=5)
+        resp = requests.get(url, timeout=self.timeout)
         return resp.status_code == 200
 
 
@@ -86,6 +145,128 @@ class NodeHealth(object):
         return check_systemd('networkd.service')
 
 
+class FleetHealth(object):
+    """
+    run the NodeHealth checks on many nodes at once: the http services are
+    probed directly and the systemd units of a node are read by one ssh
+    command, everything of a node must finish within timeout seconds
+    """
+
+    CHECK_LIST = NodeHealth.CHECK_LIST
+    SYSTEMD_UNITS = {
+        'dnsmasq': 'dnsmasq.service',
+        'swarm_agent': 'swarm-agent.service',
+        'lainlet': 'lainlet.service',
+        'networkd': 'networkd.service',
+    }
+
+    def __init__(self, nodes, timeout=10, concurrency=32):
+        self.nodes = nodes
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    def run(self, as_json=False):
+        start = time.time()
+        reports = parallel_map(self.check_node, self.nodes, self.concurrency)
+        if as_json:
+            print(json.dumps([{
+                'node': node.name,
+                'ip': node.ip,
+                'checks': dict((r.item, r.to_dict()) for r in results),
+            } for node, results in reports], indent=4))
+        else:
+            self._print_table(reports)
+            info("%d nodes checked in %.1fs", len(reports), time.time() - start)
+        return all(r.ok for _, results in reports for r in results)
+
+    def _print_table(self, reports):
+        width = 2 + max(8, *(len(node.name) for node, _ in reports))
+        row_fmt = "%-{width}s%-17s".format(width=width) + \
+            "".join("%%-%ds" % (len(item) + 2) for item in self.CHECK_LIST)
+        print(row_fmt % tuple(["NODENAME", "IP"] + [i.upper() for i in self.CHECK_LIST]))
+        for node, results in reports:
+            print(row_fmt % tuple([node.name, node.ip] +
+                                  ["ok" if r.ok else "FAIL" for r in results]))
+        for node, results in reports:
+            for r in results:
+                if not r.ok:
+                    error("%s %s: %s", node.name, r.item, r.reason)
+
+    def check_node(self, node):
+        deadline = time.time() + self.timeout
+        units = [self.SYSTEMD_UNITS[i] for i in self.CHECK_LIST if i in self.SYSTEMD_UNITS]
+        # ask systemd over ssh while the http services are probed
+        systemd = _SystemdProbe(node, units, self.timeout)
+        results = {}
+        for item in self.CHECK_LIST:
+            if item not in self.SYSTEMD_UNITS:
+                timeout = max(deadline - time.time(), 0.1)
+                results[item] = timed_check(item, getattr(self, "check_%s" % item),
+                                            node, timeout)
+        states, reason = systemd.wait()
+        for item, unit in self.SYSTEMD_UNITS.items():
+            if item not in self.CHECK_LIST:
+                continue
+            state = states.get(unit)
+            if state == 'active':
+                results[item] = CheckResult(item, True, systemd.latency)
+            else:
+                results[item] = CheckResult(item, False, systemd.latency,
+                                            reason or "%s is %s" % (unit, state))
+        return node, [results[item] for item in self.CHECK_LIST]
+
+    def check_etcd(self, node, timeout):
+        resp = requests.get("http://%s:4001/health" % node.ip, timeout=timeout)
+        return resp.json().get('health') in (True, 'true')
+
+    def check_docker(self, node, timeout):
+        resp = requests.get("http://%s:2375/_ping" % node.ip, timeout=timeout)
+        return resp.status_code == 200
+
+
+class _SystemdProbe(object):
+    """`systemctl show` of several units in one ssh command, killed at timeout"""
+
+    def __init__(self, node, units, timeout):
+        self.start = time.time()
+        self.latency = 0
+        command = 'systemctl show -p Id -p ActiveState %s' % ' '.join(units)
+        self.process = Popen(ssh_cmd(node.ip, node.ssh_port, command,
+                                     connect_timeout=max(int(timeout), 1)),
+                             stdout=PIPE, stderr=PIPE)
+        self.timer = threading.Timer(timeout, self._kill)
+        self.timer.start()
+        self.timed_out = False
+
+    def _kill(self):
+        self.timed_out = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def wait(self):
+        output, err = self.process.communicate()
+        self.timer.cancel()
+        self.latency = time.time() - self.start
+        if self.timed_out:
+            return {}, "ssh timed out"
+        if self.process.returncode != 0:
+            lines = err.strip().splitlines()
+            return {}, "ssh failed: %s" % (lines[-1] if lines else self.process.returncode)
+        return parse_systemd_states(output), ""
+
+
+def parse_systemd_states(output):
+    """parse `systemctl show -p Id -p ActiveState` output into {unit: state}"""
+    states = {}
+    for block in output.strip().split('\n\n'):
+        props = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        if 'Id' in props:
+            states[props['Id']] = props.get('ActiveState')
+    return states
+
+
 def check_systemd(service):
     p = Popen(['systemctl', 'show', service], stdout=PIPE, stderr=PIPE)
     output, err = p.communicate()
@@ -1,12 +1,589 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from lain_admin_cli.registry import PREPARE
+from lain_admin_cli import auth, drift, registry
+from lain_admin_cli import helpers
+from lain_admin_cli.helpers import ClusterConfig, NodeInventory
+from lain_admin_cli.registry import PREPARE, Image
+from lain_admin_cli.utils import ansible_profile, cache
+from lain_admin_cli.utils.concurrency import parallel_imap, parallel_map
+from lain_admin_cli.utils.health import parse_systemd_states, run_checks
 
 
 class TestMethods(unittest.TestCase):
     def test_add(self):
         self.assertEqual(PREPARE, "prepare")
 
+    def test_parallel_map_keeps_order(self):
+        items = range(50)
+        self.assertEqual(parallel_map(lambda x: x * 2, items, 8),
+                         [x * 2 for x in items])
+        self.assertEqual(parallel_map(lambda x: x, [], 8), [])
+
+    def test_parallel_imap_reads_items_lazily(self):
+        taken = []
+
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+        results = parallel_imap(lambda x: x * 2, items(), 2)
+        self.assertEqual(next(results), 0)
+        self.assertTrue(len(taken) <= 4)
+        self.assertEqual(list(results), [x * 2 for x in range(1, 100)])
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeAuthSession(object):
+    CHALLENGE = ('Bearer realm="http://auth/token",service="registry",'
+                 'scope="repository:app:pull,delete"')
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, timeout=None):
+        self.requests.append((method, url))
+        if url.startswith('http://auth/token'):
+            return FakeResponse(200, body={'token': 't', 'expires_in': 300})
+        if headers.get('Authorization') != 'Bearer t':
+            return FakeResponse(401, {'Www-Authenticate': self.CHALLENGE})
+        return FakeResponse(200)
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, timeout=None):
+        self.requests.append((method, url))
+        return FakeResponse(202)
+
+
+class FakeUsageSession(object):
+    LAYERS = {'a': [['l1', 10], ['l2', 20]], 'b': [['l1', 10], ['l3', 5]]}
+
+    def request(self, method, url, headers=None, timeout=None):
+        repo = url.split('/v2/')[1].split('/')[0]
+        if '/tags/list' in url:
+            return FakeResponse(200, body={'tags': ['release-1-x', 'release-2-x']})
+        if method == 'HEAD':
+            return FakeResponse(200, {'Docker-Content-Digest': 'sha256:' + repo})
+        layers = [{'digest': d, 'size': size} for d, size in self.LAYERS[repo]]
+        return FakeResponse(200, body={'config': {'digest': 'c' + repo, 'size': 1},
+                                       'layers': layers})
+
+
+class TestRegistry(unittest.TestCase):
+    def test_registry_usage_counts_shared_layers_once(self):
+        usages, total = registry.registry_usage(FakeUsageSession(), ['a', 'b'], 4)
+        self.assertEqual([(u.size, u.unique) for u in usages], [(31, 21), (16, 6)])
+        self.assertEqual(usages[0].tags, [('release-1-x', 31), ('release-2-x', 31)])
+        self.assertEqual(total, 37)
+
+    def test_delete_images_dedupes_digest(self):
+        session = FakeSession()
+        images = [Image('app', 'release-1-a', 'sha256:1'),
+                  Image('app', 'release-2-b', 'sha256:1'),
+                  Image('app', 'release-3-c', 'sha256:2')]
+        results = registry._delete_images(session, images, 4)
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(results[0], ('sha256:1', ['release-1-a', 'release-2-b'], True))
+
+    def test_in_use_images_are_kept(self):
+        self.assertEqual(registry._image_ref('registry.lain.local/app:release-1-x'),
+                         ('app', 'release-1-x'))
+        self.assertEqual(registry._image_ref('localhost:5000/a/b@sha256:1'),
+                         ('a/b', 'sha256:1'))
+        pod_group = {'Spec': {'Pod': {'Containers': [
+            {'Image': 'registry.lain.local/app:release-1-x'}]}}}
+        refs = set(registry._image_ref(name)
+                   for name in registry._pod_group_images(pod_group))
+        images = [Image('app', 'release-%d-x' % i, 'sha256:%d' % i)
+                  for i in range(1, 5)]
+        registry._in_use_images = frozenset(refs)
+        try:
+            expired = registry._expired_images(images, 2, 1, 100)
+        finally:
+            registry._in_use_images = frozenset()
+        self.assertEqual([i.tag for i in expired], ['release-2-x'])
+
+    def test_plan_apply_resumes(self):
+        plan_dir = tempfile.mkdtemp()
+        plan_file = os.path.join(plan_dir, 'plan.json')
+        origin_host = registry.registry_host
+        try:
+            images = [Image('app', 'release-1-a', 'sha256:1', 'expired'),
+                      Image('app', 'release-2-b', 'sha256:1', 'expired'),
+                      Image('app', 'release-3-c', 'sha256:2', 'expired')]
+            registry.write_plan(plan_file, images)
+            with open(plan_file) as f:
+                self.assertEqual(len(json.load(f)['images']), 3)
+            with open(plan_file + '.done', 'w') as f:
+                f.write('app@sha256:1\n')
+            session = FakeSession()
+            registry.apply_plan(session, plan_file, 2, rate=100)
+            self.assertEqual([url.split('/')[-1] for _, url in session.requests],
+                             ['sha256:2'])
+            with open(plan_file + '.done') as f:
+                self.assertEqual(f.read().split(), ['app@sha256:1', 'app@sha256:2'])
+        finally:
+            registry.registry_host = origin_host
+            shutil.rmtree(plan_dir)
+
+    def test_plan_apply_keeps_images_in_use(self):
+        plan_dir = tempfile.mkdtemp()
+        plan_file = os.path.join(plan_dir, 'plan.json')
+        origin_host = registry.registry_host
+        try:
+            registry.write_plan(plan_file, [
+                Image('app', 'release-1-a', 'sha256:1', 'expired'),
+                Image('app', 'release-2-b', 'sha256:2', 'expired')])
+            # deployd rolled back to release-2-b after the plan was written
+            registry._in_use_images = frozenset([('app', 'release-2-b')])
+            session = FakeSession()
+            registry.apply_plan(session, plan_file, 2, rate=100)
+            self.assertEqual([url.split('/')[-1] for _, url in session.requests],
+                             ['sha256:1'])
+        finally:
+            registry._in_use_images = frozenset()
+            registry.registry_host = origin_host
+            shutil.rmtree(plan_dir)
+
+    def test_token_attached_once_challenged(self):
+        registry.TOKEN_CACHE.clear()
+        registry.CHALLENGE_CACHE.clear()
+        session = FakeAuthSession()
+        url = registry.MANIFEST_URL_TEMPLATE % ('r', 'app', 'release-1-a')
+        for _ in range(3):
+            self.assertTrue(registry._request(session, 'HEAD', url) is not None)
+        # 401, token, retry, then the token is sent right away
+        self.assertEqual(len(session.requests), 5)
+        self.assertTrue(registry._token_url(FakeAuthSession.CHALLENGE).endswith(
+            'scope=repository:app:pull,delete'))
+
+    def test_expired_images_keep_shared_digest(self):
+        images = [Image('app', 'release-%d-x' % i, 'sha256:%d' % i)
+                  for i in range(1, 5)]
+        images.append(Image('app', 'release-9-y', 'sha256:1'))
+        expired = registry._expired_images(images, 2, 1, 100)
+        self.assertEqual(sorted(i.tag for i in expired), ['release-2-x', 'release-3-x'])
+
+
+class FakeEtcdNode(object):
+    def __init__(self, key, value=None, dir=False):
+        self.key, self.value, self.dir = key, value, dir
+
+
+class FakeEtcdClient(object):
+    def __init__(self, leaves):
+        self.leaves = leaves
+        self.reads = 0
+
+    def read(self, key, recursive=False):
+        self.reads += 1
+        return self
+
+
+class TestNodeInventory(unittest.TestCase):
+    def test_index_nodes_and_groups(self):
+        client = FakeEtcdClient([
+            FakeEtcdNode('/lain/nodes/nodes/node1:192.168.77.21:22',
+                         '{"ip": "192.168.77.21", "ssh_port": 22, "docker_device": "/dev/vdb"}'),
+            FakeEtcdNode('/lain/nodes/nodes/node2:192.168.77.22:22', ''),
+            FakeEtcdNode('/lain/nodes/etcd-members/node1:192.168.77.21:22', ''),
+            FakeEtcdNode('/lain/nodes/swarm-managers/node2:22', ''),
+            FakeEtcdNode('/lain/nodes/managers', dir=True),
+        ])
+        inventory = NodeInventory(client)
+        self.assertEqual(client.reads, 1)
+        self.assertEqual([n.name for n in inventory.nodes()], ['node1', 'node2'])
+        node1 = inventory.find('192.168.77.21')
+        self.assertEqual((node1.name, node1.docker_device, node1.is_etcd_member),
+                         ('node1', '/dev/vdb', True))
+        node2 = inventory.find('node2')
+        self.assertEqual((node2.ssh_port, node2.is_swarm_manager, node2.is_lain_manager),
+                         (22, True, False))
+        self.assertEqual(inventory.group('swarm-managers'), {'node2': 'node2:22'})
+
+
+class TestClusterConfig(unittest.TestCase):
+    LEAVES = [
+        FakeEtcdNode('/lain/config/domain', 'lain.local'),
+        FakeEtcdNode('/lain/config/extra_domains', '["lain.example.com"]'),
+        FakeEtcdNode('/lain/config/auth', dir=True),
+        FakeEtcdNode('/lain/config/auth/registry', '{"realm": "x"}'),
+    ]
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.origin = (cache.CACHE_DIR, helpers.get_etcd_client,
+                       helpers.config_cache_ttl, dict(helpers._configs))
+        cache.CACHE_DIR = self.cache_dir
+        helpers._configs.clear()
+
+    def tearDown(self):
+        (cache.CACHE_DIR, helpers.get_etcd_client,
+         helpers.config_cache_ttl, configs) = self.origin
+        helpers._configs.clear()
+        helpers._configs.update(configs)
+        shutil.rmtree(self.cache_dir)
+
+    def test_items(self):
+        config = ClusterConfig(FakeEtcdClient(self.LEAVES))
+        self.assertEqual(sorted(config.items), ['auth/registry', 'domain', 'extra_domains'])
+        self.assertEqual(config.under('auth'), {'auth/registry': '{"realm": "x"}'})
+        self.assertEqual((config.domain, config.console_domain),
+                         ('lain.local', 'lain.example.com'))
+        self.assertEqual(ClusterConfig(items={'domain': 'lain.local'}).console_domain,
+                         'lain.local')
+
+    def test_read_once_and_cache_on_disk(self):
+        client = FakeEtcdClient(self.LEAVES)
+        helpers.get_etcd_client = lambda authority: client
+        helpers.config_cache_ttl = 60
+        helpers.get_cluster_config()
+        self.assertEqual(helpers.get_cluster_config().domain, 'lain.local')
+        self.assertEqual(client.reads, 1)
+        helpers._configs.clear()
+        self.assertEqual(helpers.get_cluster_config().domain, 'lain.local')
+        self.assertEqual(client.reads, 1)
+        helpers.get_cluster_config(use_cache=False, refresh=True)
+        self.assertEqual(client.reads, 2)
+
+
+class TestHealth(unittest.TestCase):
+    def test_run_checks_with_deadline(self):
+        def fail():
+            raise Exception("connection refused")
+        start = time.time()
+        results = run_checks([('ok', lambda: True), ('down', fail),
+                              ('slow', lambda: time.sleep(2))], 0.2)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([(r.item, r.ok, r.reason) for r in results],
+                         [('ok', True, ''), ('down', False, 'connection refused'),
+                          ('slow', False, 'timed out after 0.2s')])
+
+    def test_parse_systemd_states(self):
+        output = ("ActiveState=active\nId=dnsmasq.service\n\n"
+                  "ActiveState=failed\nId=lainlet.service\n")
+        self.assertEqual(parse_systemd_states(output),
+                         {'dnsmasq.service': 'active', 'lainlet.service': 'failed'})
+
+
+class TestWaitNodeDrained(unittest.TestCase):
+    def test_subscribes_before_counting(self):
+        from lain_admin_cli import node
+        calls = []
+
+        class FakeEvents(object):
+            def __iter__(self):
+                calls.append('wait')
+                yield {'node': {'Name': 'node2'}}
+
+            def close(self):
+                calls.append('close')
+        counts = [1, 0]
+
+        def count(nodename):
+            calls.append('count')
+            return counts.pop(0)
+
+        def subscribe(filters, timeout):
+            calls.append('subscribe')
+            return FakeEvents()
+        origin = node.swarm_events, node.count_node_containers
+        node.swarm_events, node.count_node_containers = subscribe, count
+        try:
+            self.assertTrue(node.wait_node_drained('node2', 60))
+        finally:
+            node.swarm_events, node.count_node_containers = origin
+        self.assertEqual(calls, ['subscribe', 'count', 'wait', 'close',
+                                 'subscribe', 'count', 'close'])
+
+
+class TestDrift(unittest.TestCase):
+    def test_is_drifted_pod(self):
+        class FakeContainer(object):
+            instance, drift = 2, 1
+        pod_group = {'Pods': [{'InstanceNo': 1, 'DriftCount': 5},
+                              {'InstanceNo': 2, 'DriftCount': 1}]}
+        self.assertFalse(drift.is_drifted_pod(pod_group, FakeContainer()))
+        pod_group['Pods'][1]['DriftCount'] = 2
+        self.assertTrue(drift.is_drifted_pod(pod_group, FakeContainer()))
+        self.assertFalse(drift.is_drifted_pod({'Pods': None}, FakeContainer()))
+
+    def test_transferred_bytes(self):
+        output = ('Total transferred file size: 1,024 bytes\n'
+                  'ok: [node2] => {"stdout": "Total transferred file size: 1.50M bytes\\n"}')
+        self.assertEqual(drift.transferred_bytes(output), 1024 + 3 * (1 << 19))
+        self.assertEqual(drift.transferred_bytes("ok: [node2]"), None)
+
+    def test_transferred_bytes_of_playbook_output(self):
+        output = """
+PLAY [nodes] *******************************************************************
+
+TASK [drift : sync the volumes] ************************************************
+changed: [node2] => {"changed": true, "cmd": ["rsync", "-az", "--stats", "/data/lain/volumes/hello/", "root@192.168.77.21:/data/lain/volumes/hello/"], "delta": "0:00:02.317204", "end": "2017-03-02 10:12:53.144590", "rc": 0, "start": "2017-03-02 10:12:50.827386", "stderr": "", "stdout": "\\nNumber of files: 12 (reg: 10, dir: 2)\\nNumber of created files: 0\\nNumber of deleted files: 0\\nNumber of regular files transferred: 2\\nTotal file size: 73,400,320 bytes\\nTotal transferred file size: 2,097,152 bytes\\nLiteral data: 1,024 bytes\\nMatched data: 2,096,128 bytes\\nFile list size: 0\\nTotal bytes sent: 3,412\\nTotal bytes received: 1,294\\n\\nsent 3,412 bytes  received 1,294 bytes  2,030.11 bytes/sec\\ntotal size is 73,400,320  speedup is 15,596.33", "stdout_lines": ["", "Number of files: 12 (reg: 10, dir: 2)", "Number of created files: 0", "Number of deleted files: 0", "Number of regular files transferred: 2", "Total file size: 73,400,320 bytes", "Total transferred file size: 2,097,152 bytes", "Literal data: 1,024 bytes", "Matched data: 2,096,128 bytes", "File list size: 0", "Total bytes sent: 3,412", "Total bytes received: 1,294", "", "sent 3,412 bytes  received 1,294 bytes  2,030.11 bytes/sec", "total size is 73,400,320  speedup is 15,596.33"], "warnings": []}
+
+PLAY RECAP *********************************************************************
+node2                      : ok=1    changed=1    unreachable=0    failed=0
+"""
+        self.assertEqual(drift.transferred_bytes(output), 2097152)
+
+    def test_precopy_stops_without_rsync_stats(self):
+        sizes = []
+
+        def fake_drift_volumes(playbooks_path, containers, source, target):
+            sizes.append(None)
+            return None
+        origin = drift.drift_volumes, drift.PRECOPY_SECONDS
+        drift.drift_volumes, drift.PRECOPY_SECONDS = fake_drift_volumes, -1
+        try:
+            drift.precopy_volumes('playbooks', [], None, None, 5)
+        finally:
+            drift.drift_volumes, drift.PRECOPY_SECONDS = origin
+        self.assertEqual(len(sizes), 1)
+
+    def test_group_by_source(self):
+        class FakeContainer(object):
+            def __init__(self, name, host):
+                self.name, self.host = name, host
+        containers = [FakeContainer('a', 'node2'), FakeContainer('b', 'node1'),
+                      FakeContainer('c', 'node2')]
+        self.assertEqual([(host, [c.name for c in group])
+                          for host, group in drift.group_by_source(containers)],
+                         [('node2', ['a', 'c']), ('node1', ['b'])])
+
+    def test_map_by_pod_serializes_pod_groups(self):
+        class FakeContainer(object):
+            def __init__(self, name, podname):
+                self.name, self.podname = name, podname
+        containers = [FakeContainer('web1', 'app.web.web'), FakeContainer('web2', 'app.web.web'),
+                      FakeContainer('worker1', 'app.worker.w')]
+        running, events = {}, []
+        lock = threading.Lock()
+
+        def fake_drift(container):
+            with lock:
+                running[container.podname] = running.get(container.podname, 0) + 1
+                events.append(running[container.podname])
+            time.sleep(0.05)
+            with lock:
+                running[container.podname] -= 1
+            return container.name
+        results = drift.map_by_pod(fake_drift, containers, 4)
+        self.assertEqual(results, ['web1', 'web2', 'worker1'])
+        self.assertEqual(max(events), 1)
+
+    def test_write_atomically_keeps_mode(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'meta')
+            drift.write_atomically(path, '{}')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+            os.chmod(path, 0640)
+            drift.write_atomically(path, '{"a": 1}')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0640)
+            with open(path) as f:
+                self.assertEqual(f.read(), '{"a": 1}')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestFixBackupd(unittest.TestCase):
+    class FakeNode(object):
+        def __init__(self, ip):
+            self.ip = ip
+
+    class FakeContainer(object):
+        volumes = ['/data/lain/volumes/app/app.web.web/1/var']
+
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+        self.origin_dir, drift.backup_dir = drift.backup_dir, self.backup_dir
+        source = os.path.join(self.backup_dir, '10.0.0.1')
+        os.makedirs(os.path.join(source, 'dir-backup'))
+        for path in ('file-backup', 'dir-backup/data'):
+            with open(os.path.join(source, path), 'w') as f:
+                f.write(path)
+        items = [{'name': 'file-backup'}, {'name': 'dir-backup'}, {'name': 'missing'}]
+        with open(os.path.join(source, '.meta'), 'w') as f:
+            json.dump({self.FakeContainer.volumes[0]: items}, f)
+
+    def tearDown(self):
+        drift.backup_dir = self.origin_dir
+        shutil.rmtree(self.backup_dir)
+
+    def fix(self):
+        drift.fix_backupd(self.FakeContainer(), self.FakeNode('10.0.0.1'),
+                          self.FakeNode('10.0.0.2'))
+        target = os.path.join(self.backup_dir, '10.0.0.2')
+        with open(os.path.join(target, '.meta')) as f:
+            meta = json.load(f)
+        return target, [item['name'] for item in meta[self.FakeContainer.volumes[0]]]
+
+    def test_copy_and_skip_unchanged(self):
+        target, names = self.fix()
+        self.assertEqual(names, ['file-backup', 'dir-backup'])
+        with open(os.path.join(target, 'dir-backup', 'data')) as f:
+            self.assertEqual(f.read(), 'dir-backup/data')
+        # same size and mtime is taken as unchanged, a missing file is not
+        copied = os.path.join(target, 'file-backup')
+        st = os.stat(copied)
+        with open(copied, 'w') as f:
+            f.write('x' * st.st_size)
+        os.utime(copied, (st.st_atime, st.st_mtime))
+        os.remove(os.path.join(target, 'dir-backup', 'data'))
+        target, names = self.fix()
+        self.assertEqual(names, ['file-backup', 'dir-backup'])
+        with open(copied) as f:
+            self.assertEqual(f.read(), 'x' * st.st_size)
+        self.assertTrue(os.path.exists(os.path.join(target, 'dir-backup', 'data')))
+
+
+class TestAnsibleProfile(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def test_write_report(self):
+        path = os.path.join(self.profile_dir, 'drift.json')
+        with open(path, 'w') as f:
+            json.dump({'elapsed': 9.0, 'tasks': [
+                {'name': 'gather facts', 'role': '', 'duration': 2.0,
+                 'hosts': {'node1': {'status': 'ok', 'duration': 1.0},
+                           'node2': {'status': 'ok', 'duration': 2.0}}},
+                {'name': 'rsync volumes', 'role': 'drift', 'duration': 6.0,
+                 'hosts': {'node2': {'status': 'ok', 'duration': 6.0}}},
+            ]}, f)
+        lines = ansible_profile.write_report(path)
+        self.assertEqual(lines, [
+            "total 9.0s, 2 tasks", "slowest tasks:",
+            "       6.0s  drift : rsync volumes (slowest host node2 6.0s)",
+            "       2.0s  gather facts (slowest host node2 2.0s)",
+            "per host:", "       8.0s  node2", "       1.0s  node1"])
+        with open(os.path.join(self.profile_dir, 'drift.txt')) as f:
+            self.assertEqual(f.read().splitlines(), lines)
+        self.assertEqual(ansible_profile.write_report(path + '.missing'), None)
+
+    def test_execution_env_keeps_user_settings(self):
+        config = os.path.join(self.profile_dir, 'ansible.cfg')
+        with open(config, 'w') as f:
+            f.write("[defaults]\nforks = 5\n[ssh_connection]\npipelining = False\n")
+        origin = dict(os.environ)
+        os.environ.update(ANSIBLE_CONFIG=config, ANSIBLE_GATHERING='explicit')
+        try:
+            env = ansible_profile.execution_env()
+        finally:
+            os.environ.clear()
+            os.environ.update(origin)
+        self.assertEqual(sorted(env), ['ANSIBLE_CACHE_PLUGIN', 'ANSIBLE_CACHE_PLUGIN_CONNECTION',
+                                       'ANSIBLE_CACHE_PLUGIN_TIMEOUT', 'ANSIBLE_SSH_ARGS'])
+
+
+class FakeSSOSession(object):
+    def __init__(self, groups):
+        self.groups = groups
+        self.requests = []
+
+    def get(self, url, headers=None, verify=True):
+        return FakeResponse(200, body=[{'name': g} for g in self.groups])
+
+    def request(self, method, url, headers=None, json=None, params=None, verify=True):
+        self.requests.append((method, url))
+        return FakeResponse(201)
+
+
+class TestAnsibleProfileFlag(unittest.TestCase):
+    def parser(self):
+        import argh
+        from lain_admin_cli import cli
+        parser = argh.ArghParser()
+        parser.add_commands([cli._load(location) for _, location in cli.one_level_commands])
+        for _, location in cli.two_level_commands:
+            command = cli._load(location)
+            argh.add_commands(parser, command.subcommands(),
+                              namespace=command.namespace(), help=command.help_message())
+        return parser
+
+    def test_flag_takes_no_value(self):
+        parser = self.parser()
+        for argv in (['drift', '-p', 'x', 'c1'],
+                     ['node', 'add', '-p', 'x', 'n1:1.1.1.1'],
+                     ['node', 'remove', '-p', 'x', 'n1'],
+                     ['node', 'clean', '-p', 'x', 'n1'],
+                     ['node', 'change-labels', 'n1', '-c', 'add', '-l', 'k=v', '-p', 'x'],
+                     ['network', 'recover', '-p', 'x', '-n', 'n1', '-t', 'a', '-P', 'p']):
+            self.assertFalse(parser.parse_args(argv).ansible_profile, argv)
+            self.assertTrue(parser.parse_args(argv + ['--ansible-profile']).ansible_profile, argv)
+
+
+class TestAuth(unittest.TestCase):
+    def test_add_sso_groups_skips_existing(self):
+        session = FakeSSOSession(['lainapp-lain-local-console', 'other'])
+        origin = auth.pooled_session, auth.get_console_domain
+        auth.pooled_session = lambda concurrency: session
+        auth.get_console_domain = lambda: 'lain.local'
+        try:
+            auth.add_sso_groups('http://sso', 'token', False, 4, 0)
+        finally:
+            auth.pooled_session, auth.get_console_domain = origin
+        posts = [url for method, url in session.requests if method == 'POST']
+        puts = sorted(url for method, url in session.requests if method == 'PUT')
+        self.assertEqual(len(posts), 4)
+        self.assertEqual(puts[0], 'http://sso/api/groups/lainapp-lain-local-lvault'
+                                  '/group-members/lain')
+
+
+class TestJsonCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.origin_dir, cache.CACHE_DIR = cache.CACHE_DIR, self.cache_dir
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.origin_dir
+        shutil.rmtree(self.cache_dir)
+
+    def test_persist_and_evict(self):
+        c = cache.JsonCache('test', ttl=60, max_entries=2)
+        for i in range(3):
+            c.set('k%d' % i, i)
+            c.entries['k%d' % i]['used'] = i
+        c.save()
+        c = cache.JsonCache('test', ttl=60, max_entries=2)
+        self.assertEqual(sorted(c.entries), ['k1', 'k2'])
+        self.assertEqual(c.get('k2'), 2)
+
+    def test_hit_does_not_rewrite(self):
+        c = cache.JsonCache('test', ttl=60)
+        c.set('k', 'v')
+        c.save()
+        c = cache.JsonCache('test', ttl=60)
+        self.assertEqual(c.get('k'), 'v')
+        self.assertFalse(c.dirty)
+
+    def test_expire(self):
+        c = cache.JsonCache('test', ttl=-1)
+        c.set('k', 'v')
+        self.assertEqual(c.get('k'), None)
+        self.assertEqual(cache.JsonCache('test', ttl=60, enabled=False).get('k'), None)
+
 
 if __name__ == '__main__':
     unittest.main()